@@ -7,12 +7,13 @@ import time
 from itertools import count
 import sys
 import rlp
-from rlp.sedes import big_endian_int, Binary, binary, CountableList
+from rlp.sedes import big_endian_int, Binary, binary, CountableList, List
 from rlp.utils import decode_hex, encode_hex
 from ethereum import trie
 from ethereum.trie import Trie
 from ethereum.securetrie import SecureTrie
 from ethereum import utils
+from ethereum.db import get_family
 from ethereum.utils import address, int256, trie_root, hash32, to_string
 from ethereum import processblock
 from ethereum.transactions import Transaction
@@ -119,15 +120,15 @@ class Account(rlp.Serializable):
     ]
 
     def __init__(self, nonce, balance, storage, code_hash, db):
-        self.db = db
+        self.db = get_family(db, 'code')
         super(Account, self).__init__(nonce, balance, storage, code_hash)
 
     @property
     def code(self):
         """The EVM code of the account.
 
-        This property will be read from or written to the db at each access,
-        with :ivar:`code_hash` used as key.
+        This property will be read from or written to the 'code' family of the
+        db at each access, with :ivar:`code_hash` used as key.
         """
         return self.db.get(self.code_hash)
 
@@ -146,7 +147,7 @@ class Account(rlp.Serializable):
         :param db: the db in which the account will store its code.
         """
         code_hash = utils.sha3(b'')
-        db.put(code_hash, b'')
+        get_family(db, 'code').put(code_hash, b'')
         return cls(0, 0, trie.BLANK_ROOT, code_hash, db)
 
 
@@ -424,6 +425,9 @@ class Block(rlp.Serializable):
                receipts are stored (required)
     :param parent: optional parent which if not given may have to be loaded from
                    the database for replay
+    :param state_cache: an optional
+                        :class:`ethereum.statecache.StateCache` of committed
+                        state shared with other blocks
     """
 
     fields = [
@@ -433,7 +437,7 @@ class Block(rlp.Serializable):
     ]
 
     def __init__(self, header, transaction_list=[], uncles=[], db=None,
-                 parent=None, making=False):
+                 parent=None, making=False, state_cache=None):
         if db is None:
             raise TypeError("No database object given")
         self.db = db
@@ -457,6 +461,17 @@ class Block(rlp.Serializable):
             'all': {}
         }
         self.journal = []
+        # the layer of the journal since the last snapshot, which records the
+        # first write of each item only
+        self.journal_layer = set()
+        self.snapshots = []
+        # decoded accounts and the fields written since the last commit
+        self.account_cache = {}
+        self.dirty_fields = {}
+        # committed values shared with other blocks, valid while the state is
+        # cache_root (see StateCache)
+        self.state_cache = state_cache
+        self.cache_root = None
         if self.number > 0:
             self.ancestors = [self]
         else:
@@ -466,9 +481,9 @@ class Block(rlp.Serializable):
         if parent:
             if hasattr(parent, 'db') and self.db != parent.db:
                 raise ValueError("Parent lives in different database")
-            if self.prevhash != parent.header.hash:
+            if self.prevhash != parent.hash:
                 raise ValueError("Block's prevhash and parent's hash do not match")
-            if self.number != parent.header.number + 1:
+            if self.number != parent.number + 1:
                 raise ValueError("Block's number is not the successor of its parent number")
             if not check_gaslimit(parent, self.gas_limit):
                 raise ValueError("Block's gaslimit is inconsistent with its parent's gaslimit")
@@ -492,30 +507,40 @@ class Block(rlp.Serializable):
         state_unknown = (header.prevhash != GENESIS_PREVHASH and
                          header.state_root != trie.BLANK_ROOT and
                          (len(header.state_root) != 32 or
-                          b'validated:' + self.hash not in db) and
+                          b'validated:' + self.hash not in
+                          get_family(db, 'meta')) and
                          not making)
         if state_unknown:
             assert transaction_list is not None
             if not parent:
                 parent = self.get_parent_header()
-            self.state = SecureTrie(Trie(db, parent.state_root))
+            self.state = SecureTrie(Trie(db, parent.state_root, deferred=True))
+            self.cache_root = parent.state_root
             self.transaction_count = 0
             self.gas_used = 0
+            # warm the node cache for the accounts the block surely touches
+            touched = set([header.coinbase])
+            for tx in transaction_list:
+                touched.update([tx.sender, tx.to])
+            self.state.prefetch([a for a in touched if a])
             # replay
             for tx in transaction_list:
                 success, output = processblock.apply_transaction(self, tx)
             self.finalize()
         else:
             # trust the state root in the header
-            self.state = SecureTrie(Trie(self.db, header._state_root))
-            self.transaction_count = 0
-            if transaction_list:
-                for tx in transaction_list:
-                    self.add_transaction_to_list(tx)
+            self.state = SecureTrie(Trie(self.db, header._state_root,
+                                         deferred=True))
+            self.cache_root = header._state_root
+            # the receipts are not known without replaying the transactions,
+            # so only the transaction trie is built
+            transaction_list = transaction_list or []
+            self.transactions = Trie.from_sorted_items(self.db, sorted(
+                (rlp.encode(i), rlp.encode(tx))
+                for i, tx in enumerate(transaction_list)))
+            self.transaction_count = len(transaction_list)
             if self.transactions.root_hash != header.tx_list_root:
                 raise ValueError("Transaction list root hash does not match")
-            # receipts trie populated by add_transaction_to_list is incorrect
-            # (it doesn't know intermediate states), so reset it
             self.receipts = Trie(self.db, header.receipts_root)
 
         # checks ##############################
@@ -561,12 +586,15 @@ class Block(rlp.Serializable):
             raise ValueError("Extra data cannot exceed 1024 bytes")
         if self.header.coinbase == '':
             raise ValueError("Coinbase cannot be empty address")
-        if not self.state.root_hash_valid():
+        # the state of blocks validated before may have been pruned since
+        meta = get_family(self.db, 'meta')
+        if not self.state.root_hash_valid() and \
+                b'validated:' + self.hash not in meta:
             raise ValueError("State Merkle root of block %r not found in "
                              "database" % self)
         if (not self.is_genesis() and self.nonce and not self.header.check_pow()):
             raise ValueError("PoW check failed")
-        self.db.put(b'validated:' + self.hash, '1')
+        meta.put(b'validated:' + self.hash, '1')
 
     @classmethod
     def init_from_header(cls, header_rlp, db):
@@ -580,10 +608,13 @@ class Block(rlp.Serializable):
 
     @classmethod
     def init_from_parent(cls, parent, coinbase, nonce=b'', extra_data=b'',
-                         timestamp=int(time.time()), uncles=[]):
+                         timestamp=int(time.time()), uncles=[],
+                         state_cache=None):
         """Create a new block based on a parent block.
 
         The block will not include any transactions and will not be finalized.
+        It shares the :class:`ethereum.statecache.StateCache` of the parent
+        unless `state_cache` is given.
         """
         header = BlockHeader(prevhash=parent.hash,
                              uncles_hash=utils.sha3(rlp.encode(uncles)),
@@ -600,8 +631,10 @@ class Block(rlp.Serializable):
                              timestamp=timestamp,
                              extra_data=extra_data,
                              nonce=nonce)
+        if state_cache is None:
+            state_cache = parent.state_cache
         block = Block(header, [], uncles, db=parent.db,
-                      parent=parent, making=True)
+                      parent=parent, making=True, state_cache=state_cache)
         block.ancestors += parent.ancestors
         return block
 
@@ -645,11 +678,16 @@ class Block(rlp.Serializable):
     @property
     def state_root(self):
         self.commit_state()
-        return self.state.root_hash
+        root_hash = self.state.root_hash
+        if self.state_cache is not None:
+            self.cache_root = self.state_cache.rename(self.cache_root,
+                                                      root_hash)
+        return root_hash
 
     @state_root.setter
     def state_root(self, value):
-        self.state = SecureTrie(Trie(self.db, value))
+        self.state = SecureTrie(Trie(self.db, value, deferred=True))
+        self.cache_root = value
         self.reset_cache()
 
     @property
@@ -670,7 +708,7 @@ class Block(rlp.Serializable):
         if len(self.uncles) > MAX_UNCLES:
             return False
         for uncle in self.uncles:
-            assert uncle.prevhash in self.db
+            assert has_block(self.db, uncle.prevhash)
             if uncle.number == self.number:
                 log.error("uncle at same block height", block=self)
                 return False
@@ -715,8 +753,21 @@ class Block(rlp.Serializable):
         return self.ancestors[:n + 1]
 
     def get_ancestor(self, n):
-        """Get the `n`th ancestor of this block."""
-        return self.get_ancestor_list(n)[-1]
+        """Get the header of the `n`th ancestor of this block, or `None` if
+        it would precede the genesis block.
+
+        Ancestors not memoized in :attr:`ancestors` are looked up as headers,
+        without decoding their transactions.
+        """
+        if n < len(self.ancestors):
+            ancestor = self.ancestors[n]
+            return ancestor.header if ancestor else None
+        header = self.ancestors[-1] and self.ancestors[-1].header
+        for i in range(n - len(self.ancestors) + 1):
+            if header is None or header.number == 0:
+                return None
+            header = get_block_header(self.db, header.prevhash)
+        return header
 
     def is_genesis(self):
         """`True` if this block is the genesis block, otherwise `False`."""
@@ -726,18 +777,33 @@ class Block(rlp.Serializable):
     def _get_acct(self, address):
         """Get the account with the given address.
 
-        Note that this method ignores cached account items.
+        The account is decoded once and kept until the caches are reset, so
+        the returned object is shared between callers. Note that this method
+        ignores cached account items.
         """
         if len(address) == 40:
             address = decode_hex(address)
         assert len(address) == 20 or len(address) == 0
-        rlpdata = self.state.get(address)
+        if address in self.account_cache:
+            return self.account_cache[address]
+        rlpdata = self._get_acct_rlp(address)
         if rlpdata != trie.BLANK_NODE:
             acct = rlp.decode(rlpdata, Account, db=self.db)
         else:
             acct = Account.blank_account(self.db)
+        self.account_cache[address] = acct
         return acct
 
+    def _get_acct_rlp(self, address):
+        "the committed account, read through the shared state cache"
+        if self.state_cache is None:
+            return self.state.get(address)
+        rlpdata = self.state_cache.get_account(self.cache_root, address)
+        if rlpdata is None:
+            rlpdata = self.state.get(address)
+            self.state_cache.put_account(self.cache_root, address, rlpdata)
+        return rlpdata
+
     def _get_acct_item(self, address, param):
         """Get a specific parameter of a specific account.
 
@@ -769,11 +835,16 @@ class Block(rlp.Serializable):
         assert len(address) == 20
         self.set_and_journal(param, address, value)
         self.set_and_journal('all', address, True)
+        self.dirty_fields.setdefault(address, set()).add(param)
 
     def set_and_journal(self, cache, index, value):
         prev = self.caches[cache].get(index, None)
         if prev != value:
-            self.journal.append([cache, index, prev, value])
+            # reverting a snapshot restores the value at the first write of
+            # the layer, later writes to the item need no entry
+            if (cache, index) not in self.journal_layer:
+                self.journal_layer.add((cache, index))
+                self.journal.append([cache, index, prev, value])
             self.caches[cache][index] = value
 
     def _delta_item(self, address, param, value):
@@ -968,12 +1039,17 @@ class Block(rlp.Serializable):
         if CACHE_KEY in self.caches:
             if index in self.caches[CACHE_KEY]:
                 return self.caches[CACHE_KEY][index]
+        storage_root = self._get_acct_item(address, 'storage')
+        if self.state_cache is not None:
+            value = self.state_cache.get_storage(storage_root, index)
+            if value is not None:
+                return value
         key = utils.zpad(utils.coerce_to_bytes(index), 32)
-        storage = self.get_storage(address).get(key)
-        if storage:
-            return rlp.decode(storage, big_endian_int)
-        else:
-            return 0
+        storage = SecureTrie(Trie(self.db, storage_root)).get(key)
+        value = rlp.decode(storage, big_endian_int) if storage else 0
+        if self.state_cache is not None:
+            self.state_cache.put_storage(storage_root, index, value)
+        return value
 
     def set_storage_data(self, address, index, value):
         """Set a specific item in the storage of an account.
@@ -995,7 +1071,8 @@ class Block(rlp.Serializable):
         if len(address) == 40:
             address = decode_hex(address)
         assert len(address) == 20
-        return len(self.state.get(address)) > 0 or address in self.caches['all']
+        return len(self._get_acct_rlp(address)) > 0 or \
+            address in self.caches['all']
 
     def add_log(self, log):
         self.logs.append(log)
@@ -1010,27 +1087,49 @@ class Block(rlp.Serializable):
             # log_state.trace('delta', changes=[])
             return
         addresses = sorted(list(self.caches['all'].keys()))
+        self.state.prefetch(addresses)
+        # a blank trie, e.g. of the genesis block, is built in one pass
+        new_state = self.state.trie.root_node == trie.BLANK_NODE
+        written = {}
         for addr in addresses:
             acct = self._get_acct(addr)
 
-            # storage
+            # only fields written since the last commit, a reverted write
+            # has left the cache again
+            dirty = self.dirty_fields.get(addr, ())
             for field in ('balance', 'nonce', 'code', 'storage'):
-                if addr in self.caches[field]:
+                if field in dirty and addr in self.caches[field]:
                     v = self.caches[field][addr]
                     changes.append([field, addr, v])
                     setattr(acct, field, v)
 
-            t = SecureTrie(Trie(self.db, acct.storage))
-            for k, v in self.caches.get(b'storage:' + addr, {}).items():
-                enckey = utils.zpad(utils.coerce_to_bytes(k), 32)
-                val = rlp.encode(v)
+            # the dirty slots are applied in one batch, an empty value deletes
+            storage = self.caches.get(b'storage:' + addr, {})
+            slots = []
+            for k, v in storage.items():
                 changes.append(['storage', addr, k, v])
-                if v:
-                    t.update(enckey, val)
-                else:
-                    t.delete(enckey)
+                slots.append((utils.zpad(utils.coerce_to_bytes(k), 32),
+                              rlp.encode(v) if v else trie.BLANK_NODE))
+            if acct.storage == trie.BLANK_ROOT:
+                t = SecureTrie.from_items(self.db, [s for s in slots if s[1]])
+            else:
+                t = SecureTrie(Trie(self.db, acct.storage, deferred=True))
+                t.update_many(slots)
             acct.storage = t.root_hash
-            self.state.update(addr, rlp.encode(acct))
+            written[addr] = rlp.encode(acct)
+            if self.state_cache is not None:
+                for k, v in storage.items():
+                    self.state_cache.put_storage(acct.storage, k, v)
+        if new_state:
+            self.state = SecureTrie.from_items(self.db, written.items(),
+                                               deferred=True)
+        else:
+            self.state.update_many(written.items())
+        # store the nodes, so the committed state is complete in the database
+        self.state.commit()
+        if self.state_cache is not None:
+            self.cache_root = self.state_cache.advance(self.cache_root,
+                                                       written)
         log_state.trace('delta', changes=changes)
         self.reset_cache()
 
@@ -1044,6 +1143,12 @@ class Block(rlp.Serializable):
         assert len(address) == 20
         self.commit_state()
         self.state.delete(address)
+        self.state.commit()
+        # only reads are cached after the commit, some of them of the account
+        self.reset_cache()
+        if self.state_cache is not None:
+            self.cache_root = self.state_cache.advance(
+                self.cache_root, {address: trie.BLANK_NODE})
 
     def account_to_dict(self, address, with_storage_root=False,
                         with_storage=True):
@@ -1075,20 +1180,17 @@ class Block(rlp.Serializable):
             med_dict['storage_root'] = encode_hex(storage_trie.get_root_hash())
         if with_storage:
             med_dict['storage'] = {}
-            d = storage_trie.to_dict()
             subcache = self.caches.get(b'storage:' + address, {})
-            subkeys = [utils.zpad(utils.coerce_to_bytes(kk), 32)
-                       for kk in list(subcache.keys())]
-            for k in list(d.keys()) + subkeys:
-                v = d.get(k, None)
-                v2 = subcache.get(utils.big_endian_to_int(k), None)
-                hexkey = b'0x' + encode_hex(utils.zunpad(k))
-                if v2 is not None:
-                    if v2 != 0:
-                        med_dict['storage'][hexkey] = \
-                            b'0x' + encode_hex(utils.int_to_big_endian(v2))
-                elif v is not None:
+            for k, v in storage_trie.iter_items():
+                if utils.big_endian_to_int(k) not in subcache:
+                    hexkey = b'0x' + encode_hex(utils.zunpad(k))
                     med_dict['storage'][hexkey] = b'0x' + encode_hex(rlp.decode(v))
+            for kk, v2 in subcache.items():
+                if v2 != 0:
+                    k = utils.zpad(utils.coerce_to_bytes(kk), 32)
+                    hexkey = b'0x' + encode_hex(utils.zunpad(k))
+                    med_dict['storage'][hexkey] = \
+                        b'0x' + encode_hex(utils.int_to_big_endian(v2))
 
         return med_dict
 
@@ -1102,51 +1204,48 @@ class Block(rlp.Serializable):
             'storage': {},
         }
         self.journal = []
+        self.journal_layer = set()
+        self.snapshots = []
+        self.account_cache = {}
+        self.dirty_fields = {}
 
     def snapshot(self):
-        """Make a snapshot of the current state to enable later reverting."""
-        return {
-            'state': self.state.root_hash,
-            'gas': self.gas_used,
-            'txs': self.transactions,
-            'txcount': self.transaction_count,
-            'suicides': self.suicides,
-            'logs': self.logs,
-            'refunds': self.refunds,
-            'suicides_size': len(self.suicides),
-            'logs_size': len(self.logs),
-            'journal': self.journal,  # pointer to reference, so is not static
-            'journal_size': len(self.journal),
-            'ether_delta': self.ether_delta
-        }
+        """Make a snapshot of the current state to enable later reverting.
+
+        The state trie is only written by :meth:`commit_state`, so a snapshot
+        records the length of the journal and starts a new layer of it. The
+        returned marker is valid until the state is committed.
+        """
+        self.snapshots.append((len(self.journal), self.gas_used,
+                               self.transactions, self.transaction_count,
+                               len(self.suicides), len(self.logs),
+                               self.refunds, self.ether_delta))
+        self.journal_layer = set()
+        return len(self.snapshots) - 1
 
     def revert(self, mysnapshot):
         """Revert to a previously made snapshot.
 
         Reverting is for example necessary when a contract runs out of gas
-        during execution.
+        during execution. Snapshots made after `mysnapshot` are dropped.
         """
-        self.journal = mysnapshot['journal']
+        (journal_size, self.gas_used, self.transactions,
+         self.transaction_count, suicides_size, logs_size, self.refunds,
+         self.ether_delta) = self.snapshots[mysnapshot]
+        del self.snapshots[mysnapshot:]
         log_state.trace('reverting')
-        while len(self.journal) > mysnapshot['journal_size']:
-            cache, index, prev, post = self.journal.pop()
+        for cache, index, prev, post in reversed(self.journal[journal_size:]):
             log_state.trace('%r %r %r %r' % (cache, index, prev, post))
             if prev is not None:
                 self.caches[cache][index] = prev
             else:
                 del self.caches[cache][index]
-        self.suicides = mysnapshot['suicides']
-        while len(self.suicides) > mysnapshot['suicides_size']:
-            self.suicides.pop()
-        self.logs = mysnapshot['logs']
-        while len(self.logs) > mysnapshot['logs_size']:
-            self.logs.pop()
-        self.refunds = mysnapshot['refunds']
-        self.state.root_hash = mysnapshot['state']
-        self.gas_used = mysnapshot['gas']
-        self.transactions = mysnapshot['txs']
-        self.transaction_count = mysnapshot['txcount']
-        self.ether_delta = mysnapshot['ether_delta']
+        del self.journal[journal_size:]
+        # the items written in the layer continued here are not known any
+        # more, recording their next writes again does no harm
+        self.journal_layer = set()
+        del self.suicides[suicides_size:]
+        del self.logs[logs_size:]
 
     def finalize(self):
         """Apply rewards and commit."""
@@ -1193,7 +1292,7 @@ class Block(rlp.Serializable):
         b["transactions"] = txlist
         if with_state:
             state_dump = {}
-            for address, v in self.state.to_dict().items():
+            for address, v in self.state.iter_items():
                 state_dump[encode_hex(address)] = self.account_to_dict(address, with_storage_roots)
             b['state'] = state_dump
         if with_uncles:
@@ -1230,31 +1329,15 @@ class Block(rlp.Serializable):
 
     def has_parent(self):
         """`True` if this block has a known parent, otherwise `False`."""
-        try:
-            self.get_parent()
-            return True
-        except UnknownParentException:
-            return False
+        return self.number > 0 and has_block(self.db, self.prevhash)
 
     def chain_difficulty(self):
         """Get the summarized difficulty.
 
         If the summarized difficulty is not stored in the database, it will be
-        calculated recursively and put in the database.
+        calculated from the headers of the ancestors and put in the database.
         """
-        if self.is_genesis():
-            return self.difficulty
-        elif b'difficulty:' + encode_hex(self.hash) in self.db:
-            encoded = self.db.get(b'difficulty:' + encode_hex(self.hash))
-            return utils.decode_int(encoded)
-        else:
-            o = self.difficulty + self.get_parent().chain_difficulty()
-            # o += sum([uncle.difficulty for uncle in self.uncles])
-            self.state.db.put(b'difficulty:' + encode_hex(self.hash),
-                              utils.encode_int(o))
-            return o
-
-            return rlp.decode(rlp.encode(l)) == l
+        return chain_difficulty(self.db, self.header)
 
     def __eq__(self, other):
         """Two blocks are equal iff they have the same hash."""
@@ -1335,8 +1418,34 @@ class CachedBlock(Block):
         return blk
 
 
+# the transactions and uncles of a block, stored apart from its header
+block_body = List([CountableList(Transaction), CountableList(BlockHeader)])
+
+
+def store_block(db, blk):
+    """Store the header and the body of a block.
+
+    Both are kept in the 'blocks' family, under ``header:<hash>`` and
+    ``body:<hash>``, so the header can be read without the transactions.
+    """
+    blocks = get_family(db, 'blocks')
+    blocks.put(b'header:' + blk.hash, rlp.encode(blk.header))
+    blocks.put(b'body:' + blk.hash,
+               rlp.encode([blk.transaction_list, blk.uncles], block_body))
+
+
+def has_block(db, blockhash):
+    blocks = get_family(db, 'blocks')
+    # blocks stored by older versions are RLP encoded whole under their hash
+    return b'header:' + blockhash in blocks or blockhash in blocks
+
+
 def get_block_header(db, blockhash):
-    bh = BlockHeader.from_block_rlp(db.get(blockhash))
+    blocks = get_family(db, 'blocks')
+    try:
+        bh = rlp.decode(blocks.get(b'header:' + blockhash), BlockHeader)
+    except KeyError:
+        bh = BlockHeader.from_block_rlp(blocks.get(blockhash))
     if bh.hash != blockhash:
         log.warn('BlockHeader.hash is broken')
         bh._fimxe_hash = blockhash
@@ -1344,21 +1453,47 @@ def get_block_header(db, blockhash):
     return bh
 
 
+def chain_difficulty(db, header):
+    """Get the summarized difficulty of the block with the given header.
+
+    The ancestors are walked as headers only. Summarized difficulties are
+    memoized in the 'meta' family of the database.
+    """
+    meta = get_family(db, 'meta')
+    if header.prevhash == GENESIS_PREVHASH and header.nonce == GENESIS_NONCE:
+        return header.difficulty
+    key = b'difficulty:' + encode_hex(header.hash)
+    if key in meta:
+        return utils.decode_int(meta.get(key))
+    try:
+        parent = get_block_header(db, header.prevhash)
+    except KeyError:
+        raise UnknownParentException(encode_hex(header.prevhash))
+    o = header.difficulty + chain_difficulty(db, parent)
+    meta.put(key, utils.encode_int(o))
+    return o
+
+
 @lru_cache(500)
 def get_block(db, blockhash):
     """
     Assumption: blocks loaded from the db are not manipulated
                 -> can be cached including hash
     """
-    blk = rlp.decode(db.get(blockhash), Block, db=db)
+    blocks = get_family(db, 'blocks')
+    try:
+        header = rlp.decode(blocks.get(b'header:' + blockhash), BlockHeader)
+    except KeyError:
+        blk = rlp.decode(blocks.get(blockhash), Block, db=db)
+    else:
+        transaction_list, uncles = rlp.decode(blocks.get(b'body:' + blockhash),
+                                              block_body)
+        blk = Block(header, transaction_list, uncles, db=db)
     return CachedBlock.create_cached(blk)
 
 
-# def has_block(blockhash):
-#    return blockhash in db.DB(utils.get_db_path())
-
-
-def genesis(db, start_alloc=GENESIS_INITIAL_ALLOC, difficulty=GENESIS_DIFFICULTY):
+def genesis(db, start_alloc=GENESIS_INITIAL_ALLOC, difficulty=GENESIS_DIFFICULTY,
+            state_cache=None):
     """Build the genesis block."""
     # https://ethereum.etherpad.mozilla.org/11
     header = BlockHeader(
@@ -1378,7 +1513,7 @@ def genesis(db, start_alloc=GENESIS_INITIAL_ALLOC, difficulty=GENESIS_DIFFICULTY
         mixhash=GENESIS_MIXHASH,
         nonce=GENESIS_NONCE,
     )
-    block = Block(header, [], [], db=db)
+    block = Block(header, [], [], db=db, state_cache=state_cache)
     for addr, data in start_alloc.items():
         if len(addr) == 40:
             addr = decode_hex(addr)
@@ -5,7 +5,10 @@ from ethereum.utils import to_string, is_string
 import rlp
 from rlp.utils import encode_hex
 from ethereum import blocks
+from ethereum.db import get_family
 from ethereum import processblock
+from ethereum.pruning import StatePruner
+from ethereum.statecache import StateCache
 from ethereum.slogging import get_logger
 log = get_logger('eth.chain')
 
@@ -25,7 +28,8 @@ class Index(object):
     """
 
     def __init__(self, db, index_transactions=True):
-        self.db = db
+        self.blockchain = db
+        self.db = get_family(db, 'index')
         self._index_transactions = index_transactions
 
     def add_block(self, blk):
@@ -39,14 +43,16 @@ class Index(object):
 
     def update_blocknumbers(self, blk):
         "start from head and update until the existing indices match the block"
+        items = []
         while True:
-            self.db.put(self._block_by_number_key(blk.number), blk.hash)
+            items.append((self._block_by_number_key(blk.number), blk.hash))
             if blk.number == 0:
                 break
-            blk = blk.get_parent()
+            blk = blocks.get_block_header(self.blockchain, blk.prevhash)
             if self.has_block_by_number(blk.number) and \
                     self.get_block_by_number(blk.number) == blk.hash:
                 break
+        self.db.put_many(items)
 
     def has_block_by_number(self, number):
         return self._block_by_number_key(number) in self.db
@@ -58,13 +64,13 @@ class Index(object):
     # transactions #############
     def _add_transactions(self, blk):
         "'tx_hash' -> 'rlp([blockhash,tx_number])"
-        for i, tx in enumerate(blk.get_transactions()):
-            self.db.put(tx.hash, rlp.encode([blk.hash, i]))
+        self.db.put_many((tx.hash, rlp.encode([blk.hash, i]))
+                         for i, tx in enumerate(blk.get_transactions()))
 
     def get_transaction(self, txhash):
         "return (tx, block, index)"
         blockhash, tx_num_enc = rlp.decode(self.db.get(txhash))
-        blk = rlp.decode(self.db.get(blockhash), blocks.Block, db=self.db)
+        blk = blocks.get_block(self.blockchain, blockhash)
         num = utils.decode_int(tx_num_enc)
         tx_data = blk.get_transaction(num)
         return tx_data, blk, num
@@ -95,13 +101,24 @@ class Chain(object):
 
     :ivar head_candidate: the block which if mined by our miner would become
                           the new head
+    :param prune_depth: `None` to keep the state of all blocks, otherwise the
+                        state of blocks more than `prune_depth` numbers below
+                        the head is deleted (see :class:`StatePruner`)
+    :param state_cache_size: the number of accounts and of storage values the
+                             blocks of the chain share in a
+                             :class:`StateCache`, `0` to not cache them
     """
     head_candidate = None
 
-    def __init__(self, db, genesis=None, new_head_cb=None, coinbase='\x00' * 20):
+    def __init__(self, db, genesis=None, new_head_cb=None, coinbase='\x00' * 20,
+                 prune_depth=None, state_cache_size=100000):
+        self.state_cache = StateCache(state_cache_size) \
+            if state_cache_size else None
         self.db = self.blockchain = db
+        self.meta = get_family(db, 'meta')
         self.new_head_cb = new_head_cb
         self.index = Index(db)
+        self.pruner = StatePruner(db, prune_depth)
         self._coinbase = coinbase
         if genesis:
             self._initialize_blockchain(genesis)
@@ -117,9 +134,11 @@ class Chain(object):
             log.info('new genesis', genesis_hash=genesis)
             self.index.add_block(genesis)
         self._store_block(genesis)
+        self.pruner.add_root(genesis.number, genesis.state_root)
         assert genesis == blocks.get_block(self.blockchain, genesis.hash)
         self._update_head(genesis)
         assert genesis.hash in self
+        self.commit()
 
     @property
     def coinbase(self):
@@ -134,19 +153,22 @@ class Chain(object):
 
     @property
     def head(self):
-        if self.blockchain is None or 'HEAD' not in self.blockchain:
+        if self.blockchain is None or 'HEAD' not in self.meta:
             self._initialize_blockchain()
-        ptr = self.blockchain.get('HEAD')
+        ptr = self.meta.get('HEAD')
         return blocks.get_block(self.blockchain, ptr)
 
     def _update_head(self, block):
         if not block.is_genesis():
             #assert self.head.chain_difficulty() < block.chain_difficulty()
-            if block.get_parent() != self.head:
+            if block.prevhash != self.head.hash:
                 log.debug('New Head is on a different branch',
                           head_hash=block, old_head_hash=self.head)
-        self.blockchain.put('HEAD', block.hash)
+        self.meta.put('HEAD', block.hash)
         self.index.update_blocknumbers(self.head)
+        # prune before the head candidate is built, so it can not reference
+        # nodes deleted afterwards
+        self.pruner.prune(block.number)
         self._update_head_candidate()
         if self.new_head_cb and not block.is_genesis():
             self.new_head_cb(block)
@@ -169,7 +191,8 @@ class Chain(object):
         # create block
         ts = max(int(time.time()), self.head.timestamp + 1)
         head_candidate = blocks.Block.init_from_parent(self.head, coinbase=self._coinbase,
-                                                       timestamp=ts, uncles=uncles)
+                                                       timestamp=ts, uncles=uncles,
+                                                       state_cache=self.state_cache)
         assert head_candidate.validate_uncles()
 
         self.pre_finalize_state_root = head_candidate.state_root
@@ -190,13 +213,19 @@ class Chain(object):
             return self.get_brothers(block.get_parent())
 
     def get_brothers(self, block):
-        """Return the uncles of the hypothetical child of `block`."""
+        """Return the uncles of the hypothetical child of `block`.
+
+        The ancestors of `block` are walked as headers, only the uncles are
+        decoded as blocks.
+        """
         o = []
         i = 0
-        while block.has_parent() and i < blocks.MAX_UNCLE_DEPTH:
-            parent = block.get_parent()
-            o.extend([u for u in self.get_children(parent) if u != block])
-            block = block.get_parent()
+        header = block.header
+        while header.number > 0 and self.has_block(header.prevhash) and \
+                i < blocks.MAX_UNCLE_DEPTH:
+            o.extend([self.get(c) for c in self.index.get_children(header.prevhash)
+                      if c != header.hash])
+            header = blocks.get_block_header(self.blockchain, header.prevhash)
             i += 1
         return o
 
@@ -208,17 +237,31 @@ class Chain(object):
     def has_block(self, blockhash):
         assert is_string(blockhash)
         assert len(blockhash) == 32
-        return blockhash in self.blockchain
+        return blocks.has_block(self.blockchain, blockhash)
 
     def __contains__(self, blockhash):
         return self.has_block(blockhash)
 
     def _store_block(self, block):
-        self.blockchain.put(block.hash, rlp.encode(block))
+        blocks.store_block(self.blockchain, block)
 
     def commit(self):
         self.blockchain.commit()
 
+    def rollback(self):
+        """Discard all changes since the last commit.
+
+        Use this after a block decoded into the chain's database turned out to
+        be invalid, so its state is not kept. The head candidate is rebuilt,
+        as its state may have been written after the last commit as well.
+        """
+        txs = self.get_transactions()
+        self.blockchain.rollback()
+        self.head_candidate = None
+        self._update_head_candidate()
+        for tx in txs:
+            self.add_transaction(tx)
+
     def add_block(self, block, forward=False):
         "returns True if block was added sucessfully"
         _log = log.bind(block_hash=block)
@@ -229,6 +272,7 @@ class Chain(object):
 
         if not block.validate_uncles():
             _log.debug('invalid uncles')
+            self.rollback()
             return False
 
         # check PoW and forward asap in order to avoid stale blocks
@@ -239,15 +283,18 @@ class Chain(object):
         elif not block.header.check_pow(nonce=block.nonce) and\
                 not block.is_genesis():
             _log.debug('invalid nonce')
+            self.rollback()
             return False
 
         if block.has_parent():
             try:
-                processblock.verify(block, block.get_parent())
+                processblock.verify(block, block.get_parent_header(),
+                                    self.state_cache)
             except processblock.VerificationFailed as e:
                 _log.critical('VERIFICATION FAILED', error=e)
                 f = os.path.join(utils.data_dir, 'badblock.log')
                 open(f, 'w').write(to_string(block.hex_serialize()))
+                self.rollback()
                 return False
 
         if block.number < self.head.number:
@@ -256,6 +303,7 @@ class Chain(object):
 
         self.index.add_block(block)
         self._store_block(block)
+        self.pruner.add_root(block.number, block.state_root)
 
         # set to head if this makes the longest chain w/ most work for that number
         if block.chain_difficulty() > self.head.chain_difficulty():
@@ -328,7 +376,7 @@ class Chain(object):
         blocks = []
         block = self.head
         if start:
-            if start not in self.index.db:
+            if not self.has_block(start):
                 return []
             block = self.get(start)
             if not self.in_main_branch(block):
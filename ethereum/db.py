@@ -1,3 +1,7 @@
+import sqlite3
+from collections import OrderedDict
+from timeit import default_timer
+import rlp
 from ethereum import utils
 from ethereum.slogging import get_logger
 from rlp.utils import str_to_bytes
@@ -7,7 +11,88 @@ log = get_logger('db')
 databases = {}
 
 
-class _EphemDB(object):
+class BaseDB(object):
+
+    """Interface of the key-value databases used for state, blocks and indexes.
+
+    Writes may be buffered by an implementation until :meth:`commit` is
+    called. Reading a missing key raises :exc:`KeyError`.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def put(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """Return the values of `keys` in order, `None` for missing keys.
+
+        Backends with a per-call overhead read them in one round trip.
+        """
+        o = []
+        for key in keys:
+            try:
+                o.append(self.get(key))
+            except KeyError:
+                o.append(None)
+        return o
+
+    def put_many(self, items):
+        """Store the `(key, value)` pairs `items`."""
+        for key, value in items:
+            self.put(key, value)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        """Discard uncommitted changes, if the database buffers them."""
+        pass
+
+    def _has_key(self, key):
+        raise NotImplementedError
+
+    def __contains__(self, key):
+        return self._has_key(key)
+
+    def iter_items(self, prefix=b''):
+        """Iterate over the `(key, value)` pairs whose keys start with
+        `prefix`, in ascending key order.
+        """
+        raise NotImplementedError
+
+    def compact(self):
+        """Reclaim the space freed by deletions, if the database needs to."""
+        pass
+
+
+def _merge_items(items, changes, prefix):
+    """Merge the sorted `(key, value)` pairs `items` with the buffered
+    `changes` (`None` marking a deletion) whose keys start with `prefix`.
+    """
+    pending = sorted((k, v) for k, v in changes.items() if k.startswith(prefix))
+    i = 0
+    for key, value in items:
+        while i < len(pending) and pending[i][0] < key:
+            if pending[i][1] is not None:
+                yield pending[i]
+            i += 1
+        if i < len(pending) and pending[i][0] == key:
+            if pending[i][1] is not None:
+                yield pending[i]
+            i += 1
+        else:
+            yield key, value
+    for item in pending[i:]:
+        if item[1] is not None:
+            yield item
+
+
+class _EphemDB(BaseDB):
 
     def __init__(self):
         self.db = {}
@@ -22,6 +107,12 @@ class _EphemDB(object):
     def delete(self, key):
         del self.db[key]
 
+    def get_many(self, keys):
+        return [self.db.get(key) for key in keys]
+
+    def put_many(self, items):
+        self.db.update(items)
+
     def commit(self):
         pass
 
@@ -31,6 +122,10 @@ class _EphemDB(object):
     def __contains__(self, key):
         return self._has_key(key)
 
+    def iter_items(self, prefix=b''):
+        for key in sorted(k for k in self.db if k.startswith(prefix)):
+            yield key, self.db[key]
+
     def __eq__(self, other):
         return isinstance(other, self.__class__) and self.db == other.db
 
@@ -41,7 +136,673 @@ class _EphemDB(object):
 DB = EphemDB = _EphemDB
 
 
+class SQLiteDB(BaseDB):
+
+    """Persistent database stored in a single sqlite3 file.
+
+    Puts and deletes are buffered in memory and written in one transaction
+    by :meth:`commit`, which :meth:`ethereum.chain.Chain.add_block` calls once
+    per block. Uncommitted changes are visible to reads of this instance but
+    are lost if the process dies.
+
+    :param path: the database file, created if it does not exist
+    :param sync: the fsync policy of commits: ``'off'`` leaves flushing to the
+                 OS, ``'normal'`` syncs at checkpoints (a crash may lose the
+                 latest commits, but never corrupts the file) and ``'full'``
+                 syncs every commit
+    :param cache_size: size of sqlite's page cache in KiB
+    """
+
+    sync_modes = ('off', 'normal', 'full')
+    max_variables = 500  # keys per query of get_many, sqlite allows 999
+
+    def __init__(self, path, sync='normal', cache_size=16384):
+        if sync not in self.sync_modes:
+            raise ValueError("sync must be one of %r" % (self.sync_modes,))
+        self.path = path
+        self.sync = sync
+        self.uncommitted = {}  # key -> value, None marks a deletion
+        self.conn = sqlite3.connect(path, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=%s' % sync.upper())
+        self.conn.execute('PRAGMA cache_size=-%d' % cache_size)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS kv '
+                          '(key BLOB PRIMARY KEY, value BLOB NOT NULL)')
+        log.debug('opened db', path=path, sync=sync)
+
+    def _select(self, key):
+        row = self.conn.execute('SELECT value FROM kv WHERE key=?',
+                                (sqlite3.Binary(key),)).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def get(self, key):
+        if key in self.uncommitted:
+            value = self.uncommitted[key]
+        else:
+            value = self._select(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def put(self, key, value):
+        self.uncommitted[key] = value
+
+    def delete(self, key):
+        self.uncommitted[key] = None
+
+    def get_many(self, keys):
+        found = {}
+        missing = [k for k in set(keys) if k not in self.uncommitted]
+        for i in range(0, len(missing), self.max_variables):
+            chunk = missing[i:i + self.max_variables]
+            rows = self.conn.execute(
+                'SELECT key, value FROM kv WHERE key IN (%s)' %
+                ','.join('?' * len(chunk)), [sqlite3.Binary(k) for k in chunk])
+            found.update((bytes(k), bytes(v)) for k, v in rows)
+        return [self.uncommitted[k] if k in self.uncommitted else found.get(k)
+                for k in keys]
+
+    def put_many(self, items):
+        self.uncommitted.update(items)
+
+    def commit(self):
+        if not self.uncommitted:
+            return
+        puts = [(sqlite3.Binary(k), sqlite3.Binary(v))
+                for k, v in self.uncommitted.items() if v is not None]
+        deletes = [(sqlite3.Binary(k),)
+                   for k, v in self.uncommitted.items() if v is None]
+        self.conn.execute('BEGIN')
+        try:
+            self.conn.executemany('INSERT OR REPLACE INTO kv VALUES (?, ?)', puts)
+            self.conn.executemany('DELETE FROM kv WHERE key=?', deletes)
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+        log.debug('committed', puts=len(puts), deletes=len(deletes))
+        self.uncommitted = {}
+
+    def rollback(self):
+        self.uncommitted = {}
+
+    def _has_key(self, key):
+        if key in self.uncommitted:
+            return self.uncommitted[key] is not None
+        return self._select(key) is not None
+
+    def iter_items(self, prefix=b''):
+        rows = self.conn.execute('SELECT key, value FROM kv WHERE key>=? '
+                                 'ORDER BY key', (sqlite3.Binary(prefix),))
+        committed = ((bytes(k), bytes(v)) for k, v in rows)
+        for key, value in _merge_items(committed, self.uncommitted, prefix):
+            if not key.startswith(prefix):
+                break
+            yield key, value
+
+    def compact(self):
+        self.commit()
+        self.conn.execute('VACUUM')
+
+    def close(self):
+        """Close the database file, discarding uncommitted changes."""
+        self.uncommitted = {}
+        self.conn.close()
+
+    def __repr__(self):
+        return '<SQLiteDB(%s)>' % self.path
+
+
+class OverlayDB(BaseDB):
+
+    """Buffers puts and deletes in memory on top of another database.
+
+    Reads are served from the buffer first. :meth:`commit` flushes the buffer
+    to the underlying database and commits it as one batch, :meth:`rollback`
+    discards the buffer, e.g. the trie nodes written while processing a block
+    that turned out to be invalid.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.overlay = {}  # key -> value, None marks a deletion
+
+    def get(self, key):
+        if key in self.overlay:
+            value = self.overlay[key]
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self.db.get(key)
+
+    def put(self, key, value):
+        self.overlay[key] = value
+
+    def delete(self, key):
+        self.overlay[key] = None
+
+    def get_many(self, keys):
+        missing = [k for k in keys if k not in self.overlay]
+        found = dict(zip(missing, self.db.get_many(missing)))
+        return [self.overlay[k] if k in self.overlay else found[k]
+                for k in keys]
+
+    def put_many(self, items):
+        self.overlay.update(items)
+
+    def commit(self):
+        self.db.put_many((k, v) for k, v in self.overlay.items()
+                         if v is not None)
+        for key, value in self.overlay.items():
+            if value is None:
+                try:
+                    self.db.delete(key)
+                except KeyError:
+                    pass
+        self.db.commit()
+        self.overlay = {}
+
+    def rollback(self):
+        self.overlay = {}
+
+    def _has_key(self, key):
+        if key in self.overlay:
+            return self.overlay[key] is not None
+        return self.db._has_key(key)
+
+    def iter_items(self, prefix=b''):
+        return _merge_items(self.db.iter_items(prefix), self.overlay, prefix)
+
+    def compact(self):
+        self.db.compact()
+
+    def __repr__(self):
+        return '<OverlayDB(%r)>' % self.db
+
+
+def _freeze_node(node):
+    """Store a decoded node as nested tuples, which take less memory than
+    lists and cannot be modified by accident."""
+    return tuple(_freeze_node(x) if isinstance(x, list) else x for x in node)
+
+
+def _thaw_node(node):
+    return [_thaw_node(x) if isinstance(x, tuple) else x for x in node]
+
+
+class NodeCacheDB(BaseDB):
+
+    """Keeps recently read trie nodes decoded in a bounded LRU cache.
+
+    :class:`ethereum.trie.Trie` reads nodes through :meth:`get_node` if its
+    database provides it, i.e. is an instance of this class or a
+    :class:`ColumnFamily` stored in one. Nodes are keyed by their hash, so a
+    cached node can never be stale; deleted keys are evicted nevertheless.
+
+    :param db: the database holding the encoded nodes
+    :param max_bytes: the budget of the cache, counted as the size of the
+                      encoded nodes and their keys
+    """
+
+    def __init__(self, db, max_bytes=32 * 1024 * 1024):
+        self.db = db
+        self.max_bytes = max_bytes
+        self.nodes = OrderedDict()  # key -> (node, size), oldest first
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get_node(self, key):
+        """Return the decoded node stored under `key`.
+
+        The caller gets a copy it may modify.
+        """
+        try:
+            entry = self.nodes.pop(key)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            entry = self._add(key, self.db.get(key))
+        self.nodes[key] = entry
+        return _thaw_node(entry[0])
+
+    def get_nodes(self, keys):
+        """Return the decoded nodes stored under `keys`, reading the ones not
+        cached with one :meth:`get_many`.
+        """
+        missing = [k for k in set(keys) if k not in self.nodes]
+        fetched = dict(zip(missing, self.db.get_many(missing)))
+        o = []
+        for key in keys:
+            entry = self.nodes.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                rlpdata = fetched.get(key)
+                if rlpdata is None:  # missing or evicted meanwhile
+                    rlpdata = self.db.get(key)
+                entry = self._add(key, rlpdata)
+            else:
+                self.hits += 1
+            self.nodes[key] = entry
+            o.append(_thaw_node(entry[0]))
+        return o
+
+    def _add(self, key, rlpdata):
+        "make room for the node stored as `rlpdata`, return its cache entry"
+        entry = (_freeze_node(rlp.decode(rlpdata)), len(key) + len(rlpdata))
+        self.size += entry[1]
+        while self.size > self.max_bytes and self.nodes:
+            self.size -= self.nodes.popitem(last=False)[1][1]
+            self.evictions += 1
+        return entry
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def put(self, key, value):
+        self.db.put(key, value)
+
+    def get_many(self, keys):
+        return self.db.get_many(keys)
+
+    def put_many(self, items):
+        self.db.put_many(items)
+
+    def delete(self, key):
+        entry = self.nodes.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+        self.db.delete(key)
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        # nodes read since the last commit may have been discarded
+        self.nodes.clear()
+        self.size = 0
+        self.db.rollback()
+
+    def _has_key(self, key):
+        return self.db._has_key(key)
+
+    def iter_items(self, prefix=b''):
+        return self.db.iter_items(prefix)
+
+    def compact(self):
+        self.db.compact()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, entries=len(self.nodes),
+                    size=self.size, max_bytes=self.max_bytes)
+
+    def __repr__(self):
+        return '<NodeCacheDB(%r)>' % self.db
+
+
+class ColumnFamily(BaseDB):
+
+    """A namespace of a :class:`FamilyDB`.
+
+    A family either has a database of its own or shares the default database
+    of the :class:`FamilyDB`, prefixing its keys with ``<name>:``. Iteration
+    and compaction of a family with its own database do not touch the other
+    families.
+    """
+
+    def __init__(self, families, name, db=None):
+        self.families = families
+        self.name = name
+        if db is None:
+            self.db = families.db
+            self.prefix = str_to_bytes(name) + b':'
+        else:
+            self.db = db
+            self.prefix = b''
+            if hasattr(db, 'get_node'):
+                self.get_node = db.get_node
+                self.get_nodes = db.get_nodes
+
+    def get(self, key):
+        return self.db.get(self.prefix + key)
+
+    def put(self, key, value):
+        self.db.put(self.prefix + key, value)
+
+    def delete(self, key):
+        self.db.delete(self.prefix + key)
+
+    def get_many(self, keys):
+        return self.db.get_many([self.prefix + key for key in keys])
+
+    def put_many(self, items):
+        self.db.put_many((self.prefix + k, v) for k, v in items)
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def _has_key(self, key):
+        return self.db._has_key(self.prefix + key)
+
+    def iter_items(self, prefix=b''):
+        n = len(self.prefix)
+        for key, value in self.db.iter_items(self.prefix + prefix):
+            yield key[n:], value
+
+    def compact(self):
+        self.db.compact()
+
+    def family(self, name):
+        return self.families.family(name)
+
+    def __repr__(self):
+        return '<ColumnFamily(%s, %r)>' % (self.name, self.db)
+
+
+class FamilyDB(BaseDB):
+
+    """Splits a database into column families.
+
+    Code storing one kind of data looks up its family with
+    :func:`get_family`: ``'blocks'`` (block headers and bodies by hash),
+    ``'index'`` (block numbers, children and transaction locations),
+    ``'meta'`` (head, total difficulties, validation marks), ``'nodes'`` (trie
+    nodes), ``'preimages'`` (keys of secure tries), ``'code'`` (contract code)
+    and ``'refcounts'`` (state pruning). Reads and writes through the :class:`FamilyDB` itself go
+    to the default database unprefixed.
+
+    :param db: the default database, which also stores every family not
+               given in `families` under the key prefix ``<name>:``
+    :param families: maps family names to the databases storing them, e.g.
+                     a :class:`NodeCacheDB` for ``'nodes'`` or a separate
+                     :class:`SQLiteDB` tuned for the family
+    """
+
+    def __init__(self, db, families=None):
+        self.db = db
+        self.families = {}
+        for name, family_db in (families or {}).items():
+            self.families[name] = ColumnFamily(self, name, family_db)
+
+    def family(self, name):
+        if name not in self.families:
+            self.families[name] = ColumnFamily(self, name)
+        return self.families[name]
+
+    def _databases(self):
+        dbs = [self.db]
+        for f in self.families.values():
+            if not any(f.db is db for db in dbs):
+                dbs.append(f.db)
+        return dbs
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def put(self, key, value):
+        self.db.put(key, value)
+
+    def delete(self, key):
+        self.db.delete(key)
+
+    def get_many(self, keys):
+        return self.db.get_many(keys)
+
+    def put_many(self, items):
+        self.db.put_many(items)
+
+    def commit(self):
+        for db in self._databases():
+            db.commit()
+
+    def rollback(self):
+        for db in self._databases():
+            db.rollback()
+
+    def _has_key(self, key):
+        return self.db._has_key(key)
+
+    def iter_items(self, prefix=b''):
+        return self.db.iter_items(prefix)
+
+    def compact(self):
+        for db in self._databases():
+            db.compact()
+
+    def __repr__(self):
+        return '<FamilyDB(%r, %s)>' % (self.db, sorted(self.families))
+
+
+def get_family(db, name):
+    """Return the column family `name` of `db`, or `db` itself if it is not
+    split into families.
+    """
+    if isinstance(db, (FamilyDB, ColumnFamily, RecordingDB)):
+        return db.family(name)
+    return db
+
+
+def key_prefix(key):
+    """Classify `key` by its namespace for :class:`InstrumentedDB`.
+
+    :returns: ``'hash'`` for the 32 byte hashes keying trie nodes, blocks,
+              code, preimages and the transaction index, the prefix up to and
+              including the colon of keys like ``'blocknumber:5'``, ``'ci:'``
+              or a column family's ``'nodes:'``, otherwise ``'HEAD'`` or
+              ``'other'``
+    """
+    if len(key) == 32:
+        return b'hash'
+    i = key.find(b':', 0, 16)
+    if i > 0 and key[:i].isalpha():
+        return key[:i + 1]
+    return b'HEAD' if key == b'HEAD' else b'other'
+
+
+class InstrumentedDB(BaseDB):
+
+    """Measures the operations on a database, broken down by key prefix.
+
+    For every prefix (see :func:`key_prefix`) and operation (``'get'``,
+    ``'put'``, ``'delete'`` or ``'has'``) it counts the calls, the bytes of
+    the values read or written, the time spent and a histogram of the
+    latencies in power of two microseconds. Wrap the backend below any
+    :class:`NodeCacheDB` or :class:`FamilyDB` to measure what reaches it.
+
+    :param db: the database to measure
+    :param log_commits: if true, each commit, i.e. each block added to the
+                        chain, logs the stats gathered since the previous one
+                        and resets them
+    :param classify: the function mapping keys to prefixes
+    """
+
+    def __init__(self, db, log_commits=False, classify=key_prefix):
+        self.db = db
+        self.log_commits = log_commits
+        self.classify = classify
+        self.reset()
+
+    def reset(self):
+        self.stats = {}  # (prefix, op) -> [count, bytes, seconds, histogram]
+
+    def _record(self, key, op, size, start=None, elapsed=None):
+        if elapsed is None:
+            elapsed = default_timer() - start
+        s = self.stats.get((self.classify(key), op))
+        if s is None:
+            s = self.stats[(self.classify(key), op)] = [0, 0, 0., {}]
+        s[0] += 1
+        s[1] += size
+        s[2] += elapsed
+        bucket = 1 << int(elapsed * 1e6).bit_length()
+        s[3][bucket] = s[3].get(bucket, 0) + 1
+
+    def get(self, key):
+        start = default_timer()
+        value = b''
+        try:
+            value = self.db.get(key)
+            return value
+        finally:
+            self._record(key, 'get', len(value), start)
+
+    def put(self, key, value):
+        start = default_timer()
+        self.db.put(key, value)
+        self._record(key, 'put', len(value), start)
+
+    def delete(self, key):
+        start = default_timer()
+        self.db.delete(key)
+        self._record(key, 'delete', 0, start)
+
+    def get_many(self, keys):
+        "records each key as a get taking its share of the time"
+        keys = list(keys)
+        start = default_timer()
+        values = self.db.get_many(keys)
+        elapsed = (default_timer() - start) / max(len(keys), 1)
+        for key, value in zip(keys, values):
+            self._record(key, 'get', len(value or b''), elapsed=elapsed)
+        return values
+
+    def put_many(self, items):
+        "records each key as a put taking its share of the time"
+        items = list(items)
+        start = default_timer()
+        self.db.put_many(items)
+        elapsed = (default_timer() - start) / max(len(items), 1)
+        for key, value in items:
+            self._record(key, 'put', len(value), elapsed=elapsed)
+
+    def _has_key(self, key):
+        start = default_timer()
+        o = self.db._has_key(key)
+        self._record(key, 'has', 0, start)
+        return o
+
+    def commit(self):
+        self.db.commit()
+        if self.log_commits:
+            log.info('db stats', stats=self.snapshot())
+            self.reset()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def iter_items(self, prefix=b''):
+        return self.db.iter_items(prefix)
+
+    def compact(self):
+        self.db.compact()
+
+    def snapshot(self):
+        """Return the stats as ``{prefix: {op: {'count': .., 'bytes': ..,
+        'seconds': .., 'histogram': {max microseconds: count}}}}``.
+        """
+        o = {}
+        for (prefix, op), (count, size, seconds, hist) in self.stats.items():
+            o.setdefault(prefix, {})[op] = dict(
+                count=count, bytes=size, seconds=seconds, histogram=dict(hist))
+        return o
+
+    def __repr__(self):
+        return '<InstrumentedDB(%r)>' % self.db
+
+
 # Used for SPV proof creation
+class RecordingDB(BaseDB):
+
+    """Records the trie nodes read through it, e.g. for an SPV proof.
+
+    Only the tries opened on the wrapper record, the tries opened on `db`
+    itself do not pay for it. The ``'nodes'`` family is read and written
+    through the wrapper, the other families of `db` are passed through.
+    Nodes written through the wrapper are not recorded when read back, as
+    whoever checks a proof computes them again.
+
+    :param db: the database holding the state
+    :param proof: if given, the nodes not written through the wrapper are
+                  read from this database instead of `db`, e.g. the nodes of
+                  a proof to check
+    :ivar recorded: maps the keys of the nodes read to their encoding
+    """
+
+    def __init__(self, db, proof=None):
+        self.db = db
+        self.nodes = get_family(db, 'nodes')
+        self.source = self.nodes if proof is None else proof
+        self.recorded = {}
+        self.written = set()
+
+    def family(self, name):
+        if name == 'nodes':
+            return self
+        return get_family(self.db, name)
+
+    def get_nodelist(self):
+        """Return the decoded nodes recorded."""
+        return [rlp.decode(value) for value in self.recorded.values()]
+
+    def get(self, key):
+        if key in self.written:
+            return self.nodes.get(key)
+        value = self.source.get(key)
+        self.recorded[key] = value
+        return value
+
+    def put(self, key, value):
+        self.written.add(key)
+        self.nodes.put(key, value)
+
+    def delete(self, key):
+        self.nodes.delete(key)
+
+    def get_many(self, keys):
+        values = self.source.get_many([k for k in keys
+                                       if k not in self.written])
+        values.reverse()
+        o = []
+        for key in keys:
+            if key in self.written:
+                o.append(self.nodes.get(key))
+                continue
+            value = values.pop()
+            if value is not None:
+                self.recorded[key] = value
+            o.append(value)
+        return o
+
+    def put_many(self, items):
+        items = list(items)
+        self.written.update(k for k, v in items)
+        self.nodes.put_many(items)
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def _has_key(self, key):
+        if key in self.written:
+            return self.nodes._has_key(key)
+        return self.source._has_key(key)
+
+    def iter_items(self, prefix=b''):
+        return self.source.iter_items(prefix)
+
+    def compact(self):
+        self.db.compact()
+
+    def __repr__(self):
+        return '<RecordingDB(%r)>' % self.db
+
+
 class ListeningDB(object):
 
     def __init__(self, db):
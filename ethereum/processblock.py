@@ -31,11 +31,12 @@ def mk_contract_address(sender, nonce):
     return utils.sha3(rlp.encode([sender, nonce]))[12:]
 
 
-def verify(block, parent):
+def verify(block, parent, state_cache=None):
     from ethereum import blocks
     try:
         block2 = rlp.decode(rlp.encode(block), blocks.Block,
-                            db=parent.db, parent=parent)
+                            db=block.db, parent=parent,
+                            state_cache=state_cache)
         assert block == block2
         return True
     except blocks.VerificationFailed:
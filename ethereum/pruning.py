@@ -0,0 +1,115 @@
+import rlp
+from ethereum import trie
+from ethereum import utils
+from ethereum.db import get_family
+from ethereum.slogging import get_logger
+log = get_logger('eth.pruning')
+
+
+class StatePruner(object):
+
+    """Deletes state trie nodes which are no longer reachable from the state
+    roots of recent blocks.
+
+    Every node reachable from a tracked state root carries a reference count:
+    the number of nodes referencing it plus the number of times it was added
+    as a root. Storage tries are counted as children of the account leaves
+    referencing them. A node whose count drops to zero is deleted and its
+    children are dereferenced in turn.
+
+    Nodes of transaction and receipt tries, contract code and the nodes never
+    reachable from a block's state root (intermediate states of a block) are
+    not tracked and thus never deleted.
+
+    Reference counts are kept in the 'refcounts' family of the database, so
+    they can be stored and compacted apart from the nodes.
+
+    :param db: the database holding the state
+    :param depth: `None` to keep the state of all blocks (archive mode),
+                  otherwise the number of block numbers below the head whose
+                  state is kept
+    """
+
+    roots_key = b'pruning:roots'
+
+    def __init__(self, db, depth=None):
+        assert depth is None or depth > 0
+        self.nodes = get_family(db, 'nodes')
+        self.refcounts = get_family(db, 'refcounts')
+        self.meta = get_family(db, 'meta')
+        self.depth = depth
+        if self.roots_key in self.meta:
+            self.roots = [[utils.decode_int(n), r]
+                          for n, r in rlp.decode(self.meta.get(self.roots_key))]
+        else:
+            self.roots = []  # [block number, state root], oldest first
+
+    def _refcount_key(self, key):
+        return b'refcount:' + key
+
+    def get_refcount(self, key):
+        try:
+            return utils.decode_int(self.refcounts.get(self._refcount_key(key)))
+        except KeyError:
+            return 0
+
+    def _set_refcount(self, key, count):
+        if count:
+            self.refcounts.put(self._refcount_key(key), utils.encode_int(count))
+        else:
+            self.refcounts.delete(self._refcount_key(key))
+
+    def _children(self, key, is_state):
+        refs, values = trie.node_children(rlp.decode(self.nodes.get(key)))
+        children = [(ref, is_state) for ref in refs]
+        if is_state:
+            for value in values:
+                storage_root = rlp.decode(value)[2]
+                if storage_root != trie.BLANK_ROOT:
+                    children.append((storage_root, False))
+        return children
+
+    def _incref(self, key, is_state):
+        count = self.get_refcount(key)
+        self._set_refcount(key, count + 1)
+        if count == 0:
+            for child, child_is_state in self._children(key, is_state):
+                self._incref(child, child_is_state)
+
+    def _decref(self, key, is_state):
+        count = self.get_refcount(key)
+        assert count > 0, "unreferenced node %s" % utils.encode_hex(key)
+        if count == 1:
+            children = self._children(key, is_state)
+            self.nodes.delete(key)
+            for child, child_is_state in children:
+                self._decref(child, child_is_state)
+        self._set_refcount(key, count - 1)
+
+    def _store_roots(self):
+        self.meta.put(self.roots_key, rlp.encode(
+            [[utils.encode_int(n), r] for n, r in self.roots]))
+
+    def add_root(self, number, state_root):
+        """Start tracking the state of the block with the given number."""
+        if self.depth is None or state_root == trie.BLANK_ROOT:
+            return
+        self._incref(state_root, True)
+        self.roots.append([number, state_root])
+        self._store_roots()
+
+    def prune(self, head_number):
+        """Delete the state only reachable from blocks older than
+        `head_number - depth`.
+        """
+        if self.depth is None:
+            return
+        limit = head_number - self.depth
+        expired = [r for n, r in self.roots if n <= limit]
+        if not expired:
+            return
+        self.roots = [[n, r] for n, r in self.roots if n > limit]
+        for state_root in expired:
+            self._decref(state_root, True)
+        self._store_roots()
+        log.debug('pruned', roots=len(expired), head_number=head_number)
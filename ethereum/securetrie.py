@@ -1,4 +1,7 @@
+import itertools
 from ethereum import utils
+from ethereum.trie import Trie
+from ethereum.db import get_family
 
 
 class SecureTrie(object):
@@ -6,24 +9,70 @@ class SecureTrie(object):
     def __init__(self, t):
         self.trie = t
         self.db = t.db
+        self.preimages = get_family(t.db, 'preimages')
+
+    @classmethod
+    def from_items(cls, db, items, deferred=False):
+        """Build a secure trie from (key, value) pairs in any order with
+        :meth:`Trie.from_sorted_items`."""
+        hashed = dict((utils.sha3(k), (k, v)) for k, v in items)
+        t = cls(Trie.from_sorted_items(
+            db, ((h, hashed[h][1]) for h in sorted(hashed)), deferred))
+        t.preimages.put_many((h, k) for h, (k, v) in hashed.items())
+        return t
 
     def update(self, k, v):
         h = utils.sha3(k)
-        self.db.put(h, k)
+        self.preimages.put(h, k)
         self.trie.update(h, v)
 
+    def update_many(self, items):
+        """Apply (key, value) pairs, deleting the keys whose value is empty,
+        in the order of the hashed keys with :meth:`Trie.update_many`.
+
+        Every key is hashed once and the preimages are written in one batch.
+        """
+        hashed = [(utils.sha3(k), k, v) for k, v in items]
+        self.preimages.put_many((h, k) for h, k, v in hashed if v)
+        self.trie.prefetch([h for h, k, v in hashed])
+        self.trie.update_many((h, v) for h, k, v in hashed)
+
     def get(self, k):
         return self.trie.get(utils.sha3(k))
 
     def delete(self, k):
         self.trie.delete(utils.sha3(k))
 
+    def prefetch(self, keys):
+        self.trie.prefetch([utils.sha3(k) for k in keys])
+
+    def produce_multiproof(self, keys):
+        """Prove the values of `keys`, to be checked with
+        :func:`ethereum.trie.verify_multiproof` and the hashed keys."""
+        return self.trie.produce_multiproof([utils.sha3(k) for k in keys])
+
+    def iter_items(self, reverse=False, batch_size=256):
+        """Iterate over the (key, value) pairs in the order of the hashed
+        keys, looking up the preimages of `batch_size` keys at a time.
+
+        :raises KeyError: if the preimage of a key is not stored
+        """
+        items = self.trie.iter_items(reverse=reverse)
+        while True:
+            batch = list(itertools.islice(items, batch_size))
+            if not batch:
+                return
+            keys = self.preimages.get_many([h for h, v in batch])
+            for k, (h, v) in zip(keys, batch):
+                if k is None:
+                    raise KeyError(h)
+                yield k, v
+
     def to_dict(self):
-        o = {}
-        for h, v in list(self.trie.to_dict().items()):
-            k = self.db.get(h)
-            o[k] = v
-        return o
+        return dict(self.iter_items())
+
+    def commit(self):
+        return self.trie.commit()
 
     def root_hash_valid(self):
         return self.trie.root_hash_valid()
@@ -0,0 +1,274 @@
+import mmap
+import struct
+from itertools import chain
+import rlp
+from ethereum import trie
+from ethereum import utils
+from ethereum.db import BaseDB, get_family
+from ethereum.slogging import get_logger
+log = get_logger('eth.snapshot')
+
+BLANK_CODE_HASH = utils.sha3(b'')
+
+# kinds of the values making up a state
+STATE_NODE, STORAGE_NODE, CODE = 0, 1, 2
+
+SNAPSHOT_MAGIC = b'ethsnap1'
+# magic, state root, number of index entries, offset of the index
+_header = struct.Struct('>8s32sQQ')
+# key, offset of the value, length of the value
+_entry = struct.Struct('>32sQI')
+
+STATE_MAGIC = b'ethstat1'
+# magic, state root
+_state_header = struct.Struct('>8s32s')
+# kind, length of the value
+_record = struct.Struct('>BI')
+
+
+def _references(kind, value, seen):
+    """Return `(kind, key)` of the values referenced by the node `value`.
+
+    Storage roots and code hashes in `seen` are skipped, new ones are added.
+    """
+    refs, values = trie.node_children(rlp.decode(value))
+    o = [(kind, ref) for ref in refs]
+    if kind == STATE_NODE:
+        for value in values:
+            storage_root, code_hash = rlp.decode(value)[2:4]
+            if storage_root != trie.BLANK_ROOT and storage_root not in seen:
+                seen.add(storage_root)
+                o.append((STORAGE_NODE, storage_root))
+            if code_hash != BLANK_CODE_HASH and code_hash not in seen:
+                seen.add(code_hash)
+                o.append((CODE, code_hash))
+    return o
+
+
+def _walk_state(db, state_root):
+    """Yield `(kind, key, value)` for every trie node, storage trie node
+    and contract code reachable from `state_root`, depth first, i.e. every
+    node before the values it references.
+
+    Storage tries and code shared by several accounts are yielded once. To
+    that end every distinct storage root and code hash met is remembered, so
+    besides the stack of the walk, which is bounded by the depth of the
+    tries, memory grows with the number of distinct storage tries and
+    contract codes of the state.
+    """
+    nodes, code = get_family(db, 'nodes'), get_family(db, 'code')
+    seen = set()  # storage roots and code hashes, O(contracts)
+    stack = [] if state_root == trie.BLANK_ROOT else [(STATE_NODE, state_root)]
+    while stack:
+        kind, key = stack.pop()
+        value = (code if kind == CODE else nodes).get(key)
+        yield kind, key, value
+        if kind != CODE:
+            stack.extend(reversed(_references(kind, value, seen)))
+
+
+def export_snapshot(db, state_root, path):
+    """Write the state reachable from `state_root` to a snapshot file.
+
+    The file holds the values (trie nodes and contract code) one after
+    another, followed by an index of fixed size entries sorted by key, which
+    :class:`SnapshotDB` searches in place. Preimages of secure trie keys are
+    not included, so the state can be queried by address but not listed.
+
+    :param db: the database holding the state
+    :param path: the file to write
+    :returns: the number of values written
+    """
+    index = []
+    with open(path, 'wb') as f:
+        f.write(b'\x00' * _header.size)
+        offset = _header.size
+        items = chain([(None, BLANK_CODE_HASH, b'')],
+                      _walk_state(db, state_root))
+        for _, key, value in items:
+            f.write(value)
+            index.append((key, offset, len(value)))
+            offset += len(value)
+        index.sort()
+        count = 0
+        for i, entry in enumerate(index):
+            if i and entry[0] == index[i - 1][0]:
+                continue
+            f.write(_entry.pack(*entry))
+            count += 1
+        f.seek(0)
+        f.write(_header.pack(SNAPSHOT_MAGIC, state_root, count, offset))
+    log.debug('exported snapshot', path=path, entries=count,
+              state_root=utils.encode_hex(state_root))
+    return count
+
+
+class SnapshotDB(BaseDB):
+
+    """Read-only database serving the state of a snapshot file.
+
+    The file is memory-mapped, so processes opening the same snapshot share
+    the operating system's page cache instead of holding private copies.
+    Lookups binary search the index in place and slice the value out of the
+    mapping.
+
+    Writes raise :exc:`TypeError`. Tries read from the snapshot directly; a
+    :class:`ethereum.blocks.Block`, which stores bookkeeping data even when
+    it is only read, needs the snapshot wrapped in an
+    :class:`ethereum.db.OverlayDB`.
+
+    :ivar root_hash: the state root the snapshot was exported from
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.root_hash, self.count, self.index_offset = \
+            _header.unpack_from(self.mm, 0)
+        if magic != SNAPSHOT_MAGIC:
+            self.mm.close()
+            raise ValueError("%s is not a state snapshot" % path)
+
+    def _key_at(self, i):
+        pos = self.index_offset + i * _entry.size
+        return self.mm[pos:pos + 32]
+
+    def _bisect(self, key):
+        "index of the first entry whose key is not less than `key`"
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _value_at(self, i):
+        _, offset, length = _entry.unpack_from(
+            self.mm, self.index_offset + i * _entry.size)
+        return self.mm[offset:offset + length]
+
+    def get(self, key):
+        i = self._bisect(key)
+        if i == self.count or self._key_at(i) != key:
+            raise KeyError(key)
+        return self._value_at(i)
+
+    def put(self, key, value):
+        raise TypeError("%r is read-only" % self)
+
+    def delete(self, key):
+        raise TypeError("%r is read-only" % self)
+
+    def _has_key(self, key):
+        i = self._bisect(key)
+        return i < self.count and self._key_at(i) == key
+
+    def iter_items(self, prefix=b''):
+        for i in range(self._bisect(prefix), self.count):
+            key = self._key_at(i)
+            if not key.startswith(prefix):
+                break
+            yield key, self._value_at(i)
+
+    def close(self):
+        self.mm.close()
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return '<SnapshotDB(%s)>' % self.path
+
+
+def export_state(db, state_root, fileobj):
+    """Stream the state reachable from `state_root` to `fileobj`.
+
+    The stream starts with the state root, followed by one record per trie
+    node, storage trie node or contract code: its kind, its length and the
+    raw value. The state is walked depth first, so memory use does not grow
+    with the number of trie nodes, but it does with the number of distinct
+    storage roots and code hashes, 32 bytes each plus the set overhead (see
+    :func:`_walk_state`).
+
+    :param db: the database holding the state
+    :param fileobj: a file opened for writing in binary mode
+    :returns: the number of records written
+    """
+    fileobj.write(_state_header.pack(STATE_MAGIC, state_root))
+    count = 0
+    for kind, key, value in _walk_state(db, state_root):
+        fileobj.write(_record.pack(kind, len(value)))
+        fileobj.write(value)
+        count += 1
+    log.debug('exported state', records=count,
+              state_root=utils.encode_hex(state_root))
+    return count
+
+
+def import_state(fileobj, db, batch_size=10000):
+    """Read a state written by :func:`export_state` into `db`.
+
+    Every record must be referenced by one read before, starting at the
+    state root, and have the hash it is referenced by. A stream which is
+    corrupt, truncated or holds anything else raises :exc:`ValueError`;
+    the records imported up to that point stay in the database, but no
+    state root refers to them.
+
+    Like :func:`export_state`, the import remembers every distinct storage
+    root and code hash, so memory grows with their number. The records
+    referenced but not read yet follow the depth first walk of the export
+    and stay bounded by the depth of the tries, unless the stream is
+    corrupt.
+
+    :param db: the database to store the state in
+    :param batch_size: the number of records after which `db` is committed
+    :returns: the imported state root
+    """
+    header = fileobj.read(_state_header.size)
+    if len(header) < _state_header.size:
+        raise ValueError("Truncated state stream")
+    magic, state_root = _state_header.unpack(header)
+    if magic != STATE_MAGIC:
+        raise ValueError("Not a state stream")
+    nodes, code = get_family(db, 'nodes'), get_family(db, 'code')
+    code.put(BLANK_CODE_HASH, b'')  # accounts without code refer to it
+    expected = {}  # (kind, key) -> number of references not read yet
+    if state_root != trie.BLANK_ROOT:
+        expected[(STATE_NODE, state_root)] = 1
+    seen = set()  # storage roots and code hashes, O(contracts)
+    count = 0
+    while True:
+        header = fileobj.read(_record.size)
+        if not header:
+            break
+        if len(header) < _record.size:
+            raise ValueError("Truncated state stream")
+        kind, length = _record.unpack(header)
+        value = fileobj.read(length)
+        if len(value) < length:
+            raise ValueError("Truncated state stream")
+        key = utils.sha3(value)
+        pending = expected.pop((kind, key), 0)
+        if not pending:
+            raise ValueError("Unexpected record %s in state stream" %
+                             utils.encode_hex(key))
+        if pending > 1:
+            expected[(kind, key)] = pending - 1
+        if kind == CODE:
+            code.put(key, value)
+        else:
+            nodes.put(key, value)
+            for ref in _references(kind, value, seen):
+                expected[ref] = expected.get(ref, 0) + 1
+        count += 1
+        if count % batch_size == 0:
+            db.commit()
+    if expected:
+        raise ValueError("State stream misses %d records" % len(expected))
+    db.commit()
+    log.debug('imported state', records=count,
+              state_root=utils.encode_hex(state_root))
+    return state_root
@@ -2,28 +2,59 @@ from ethereum import blocks
 from ethereum import processblock
 from ethereum import transactions
 from ethereum import utils
+from ethereum.db import EphemDB, RecordingDB
 import rlp
-from ethereum import trie
+
+
+def _open_tries(block, db):
+    """Reopen the state, transaction and receipt tries of `block` on `db`,
+    committing the state first."""
+    state_root = block.state_root
+    block.db = db
+    block.state_root = state_root
+    block.tx_list_root = block.tx_list_root
+    block.receipts_root = block.receipts_root
+
+
+def _apply_on(block, tx, db):
+    """Apply `tx` to `block` with its tries opened on `db`.
+
+    The state cache of the block is bypassed, so every node is read from
+    `db`. If the transaction fails the tries stay open on `db`.
+    """
+    original, state_cache = block.db, block.state_cache
+    block.state_cache = None
+    _open_tries(block, db)
+    try:
+        processblock.apply_transaction(block, tx)
+        _open_tries(block, original)
+    except Exception:
+        block.cache_root = None  # the state is not the one cached
+        raise
+    finally:
+        block.db, block.state_cache = original, state_cache
+
+
+def _proof_db(db, nodes):
+    """Return `db` reading the trie nodes it is not given from the proof
+    `nodes`."""
+    proof = EphemDB()
+    proof.put_many((utils.sha3(rlp.encode(n)), rlp.encode(n)) for n in nodes)
+    return RecordingDB(db, proof)
 
 
 def mk_transaction_spv_proof(block, tx):
-    trie.proof.push(trie.RECORDING)
-    processblock.apply_transaction(block, tx)
-    o = trie.proof.get_nodelist()
-    trie.proof.pop()
-    o2 = list(map(rlp.decode, list(set(map(rlp.encode, o)))))
-    return o2
+    recorder = RecordingDB(block.db)
+    _apply_on(block, tx, recorder)
+    return recorder.get_nodelist()
 
 
 def verify_transaction_spv_proof(block, tx, proof):
-    trie.proof.push(trie.VERIFYING, proof)
     try:
-        processblock.apply_transaction(block, tx)
-        trie.proof.pop()
+        _apply_on(block, tx, _proof_db(block.db, proof))
         return True
     except Exception as e:
         print(e)
-        trie.proof.pop()
         return False
 
 
@@ -38,9 +69,8 @@ def mk_independent_transaction_spv_proof(block, index):
     block.state_root = pre_med
     block.gas_used = pre_gas
     nodes = mk_transaction_spv_proof(block, tx)
-    nodes.extend(block.transactions.produce_spv_proof(rlp.encode(utils.encode_int(index))))
-    if index > 0:
-        nodes.extend(block.transactions.produce_spv_proof(rlp.encode(utils.encode_int(index - 1))))
+    keys = [rlp.encode(utils.encode_int(i)) for i in range(max(index - 1, 0), index + 1)]
+    nodes.extend(block.transactions.produce_multiproof(keys))
     nodes = list(map(rlp.decode, list(set(map(rlp.encode, nodes)))))
     print(nodes)
     return rlp.encode([utils.encode_int(64), block.get_parent().list_header(),
@@ -52,7 +82,7 @@ def verify_independent_transaction_spv_proof(db, proof):
     index = utils.decode_int(index)
     pb = blocks.Block.deserialize_header(prevheader)
     b = blocks.Block.init_from_header(db, header)
-    b.set_proof_mode(blocks.VERIFYING, nodes)
+    _open_tries(b, _proof_db(db, nodes))
     if index != 0:
         pre_med, pre_gas, _, _ = b.get_receipt(index - 1)
     else:
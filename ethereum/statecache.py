@@ -0,0 +1,113 @@
+from collections import OrderedDict
+from ethereum.slogging import get_logger
+log = get_logger('eth.statecache')
+
+
+class StateCache(object):
+
+    """Committed accounts and storage values shared by the blocks of a
+    database across transactions and blocks.
+
+    Storage values are keyed by the storage root of their account and the
+    slot. As tries are content addressed such an entry can never be stale.
+
+    Accounts are keyed by their address and are valid for one state, the
+    :attr:`root` of the cache. A block reads through the cache while its state
+    is that root. A block committing writes on top of the root moves the root
+    along, updating exactly the accounts written. A block committing on top of
+    any other state moves the root to its own lineage and drops the accounts
+    of the previous one. As long as the new state is not hashed its root is an
+    opaque token, which :meth:`rename` replaces by the state root hash.
+
+    A block is given the cache when it is created, children made with
+    :meth:`ethereum.blocks.Block.init_from_parent` share it. A
+    :class:`ethereum.chain.Chain` owns one for its head candidates and the
+    blocks it verifies.
+
+    :param max_items: the number of accounts and the number of storage values
+                      kept, the least recently used are evicted first
+    """
+
+    def __init__(self, max_items=100000):
+        self.max_items = max_items
+        self.root = None
+        self.accounts = OrderedDict()  # address -> account rlp, oldest first
+        self.storage = OrderedDict()  # (storage root, slot) -> value
+        self.hits = self.misses = self.evictions = 0
+
+    def _get(self, entries, key):
+        try:
+            value = entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entries[key] = value
+        return value
+
+    def _put(self, entries, key, value):
+        entries.pop(key, None)
+        entries[key] = value
+        while len(entries) > self.max_items:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_account(self, root, address):
+        """Return the RLP encoded account at `address` in the state `root`,
+        ``b''`` if it does not exist or `None` if it is not cached.
+        """
+        if root is None or root != self.root:
+            return None
+        return self._get(self.accounts, address)
+
+    def put_account(self, root, address, rlpdata):
+        """Cache the account read from the state `root`."""
+        if root is not None and root == self.root:
+            self._put(self.accounts, address, rlpdata)
+
+    def get_storage(self, storage_root, index):
+        """Return the value of slot `index` of the storage trie
+        `storage_root` or `None` if it is not cached.
+        """
+        return self._get(self.storage, (storage_root, index))
+
+    def put_storage(self, storage_root, index, value):
+        self._put(self.storage, (storage_root, index), value)
+
+    def advance(self, root, accounts):
+        """Record the accounts written on top of the state `root`.
+
+        :param accounts: maps the addresses written to their new RLP encoded
+                         accounts, ``b''`` for deleted accounts
+        :returns: the token identifying the new state
+        """
+        if root is None or root != self.root:
+            log.debug('switching lineage', dropped=len(self.accounts))
+            self.accounts.clear()
+        for address, rlpdata in accounts.items():
+            self._put(self.accounts, address, rlpdata)
+        self.root = object()
+        return self.root
+
+    def rename(self, root, root_hash):
+        """Identify the state `root` by its hash from now on.
+
+        :returns: `root_hash`
+        """
+        if root is not None and root is self.root:
+            self.root = root_hash
+        return root_hash
+
+    def clear(self):
+        self.root = None
+        self.accounts.clear()
+        self.storage.clear()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, accounts=len(self.accounts),
+                    storage=len(self.storage), max_items=self.max_items)
+
+    def __repr__(self):
+        return '<StateCache(accounts=%d, storage=%d)>' % (
+            len(self.accounts), len(self.storage))
@@ -0,0 +1,224 @@
+"""Microbenchmarks of Trie and SecureTrie.
+
+Every run builds a trie of random 32 byte keys and values for each size,
+then times random inserts, updates, deletes, hits and misses, a full
+iteration, the root hash computation and the production of SPV proofs. The
+results are written as JSON, so runs on different commits can be compared:
+
+    python -m ethereum.tests.benchmark_trie --sizes 1000,10000,100000 \\
+        --secure --deferred -o trie-$(git rev-parse --short HEAD).json
+
+For every operation the output has the number of operations, the seconds
+they took and the resulting ops/sec; with ``--memory`` also the peak memory
+allocated by Python while they ran (tracemalloc, Python 3 only, slows the
+timed code down). For every size it has the entries and bytes held by the
+database and the maximum resident set size of the process so far.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from ethereum import db, trie, utils
+from ethereum.securetrie import SecureTrie
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+OPERATIONS = ['insert', 'root_hash', 'get_hit', 'get_miss', 'iterate',
+              'proof', 'update', 'delete']
+
+
+def random_bytes(rng):
+    return utils.zpad(utils.int_to_big_endian(rng.getrandbits(256)), 32)
+
+
+class Workload(object):
+
+    """The keys and values of one benchmark run, derived from `seed`.
+
+    :param size: the number of keys in the trie
+    :param ops: the number of keys read, proven, updated and deleted
+    """
+
+    def __init__(self, size, ops, seed=0):
+        rng = random.Random(seed << 32 | size)
+        self.items = [(random_bytes(rng), random_bytes(rng))
+                      for _ in range(size)]
+        self.hits = [k for k, v in rng.sample(self.items, min(ops, size))]
+        self.misses = [random_bytes(rng) for _ in range(ops)]
+        self.updates = [(k, random_bytes(rng)) for k in self.hits]
+
+
+def new_trie(database, secure, deferred, root=trie.BLANK_ROOT):
+    t = trie.Trie(database, root, deferred=deferred)
+    return SecureTrie(t) if secure else t
+
+
+def produce_proof(t, key):
+    if isinstance(t, SecureTrie):
+        return t.trie.produce_spv_proof(utils.sha3(key))
+    return t.produce_spv_proof(key)
+
+
+def max_rss():
+    "the maximum resident set size of the process in bytes"
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class Timer(object):
+
+    """Times a block of operations, tracing its memory if `memory` is set."""
+
+    def __init__(self, results, name, count, memory=False):
+        self.results = results
+        self.name = name
+        self.count = count
+        self.memory = memory and tracemalloc is not None
+
+    def __enter__(self):
+        if self.memory:
+            tracemalloc.start()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.time() - self.start
+        o = dict(count=self.count, seconds=elapsed,
+                 ops_per_sec=self.count / elapsed if elapsed else None)
+        if self.memory:
+            o['peak_memory'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.results[self.name] = o
+
+
+def benchmark(size, ops=10000, secure=False, deferred=False, seed=0,
+              memory=False, operations=OPERATIONS):
+    """Run the `operations` on a trie of `size` keys, return the results.
+
+    The trie is built by `insert` whatever the `operations`. `update` and
+    `delete` change copies of it, opened on the same database at the root
+    left by `insert`.
+    """
+    w = Workload(size, ops, seed)
+    database = db.EphemDB()
+    results = {}
+
+    def timer(name, count):
+        if name in operations:
+            return Timer(results, name, count, memory)
+        return Timer({}, name, count)
+
+    t = new_trie(database, secure, deferred)
+    with timer('insert', len(w.items)):
+        for k, v in w.items:
+            t.update(k, v)
+    with timer('root_hash', 1):
+        root = t.root_hash
+    t = new_trie(database, secure, deferred, root)
+    if 'get_hit' in operations:
+        with timer('get_hit', len(w.hits)):
+            for k in w.hits:
+                t.get(k)
+    if 'get_miss' in operations:
+        with timer('get_miss', len(w.misses)):
+            for k in w.misses:
+                t.get(k)
+    if 'iterate' in operations:
+        with timer('iterate', len(w.items)):
+            for _ in t.iter_items():
+                pass
+    if 'proof' in operations:
+        with timer('proof', len(w.hits)):
+            for k in w.hits:
+                produce_proof(new_trie(database, secure, False, root), k)
+    stored = dict(entries=len(database.db),
+                  bytes=sum(len(k) + len(v) for k, v in database.db.items()))
+    if 'update' in operations:
+        t = new_trie(database, secure, deferred, root)
+        with timer('update', len(w.updates)):
+            for k, v in w.updates:
+                t.update(k, v)
+            t.root_hash
+    if 'delete' in operations:
+        t = new_trie(database, secure, deferred, root)
+        with timer('delete', len(w.hits)):
+            for k in w.hits:
+                t.delete(k)
+            t.root_hash
+    return dict(trie='SecureTrie' if secure else 'Trie', size=size,
+                deferred=deferred, stored=stored, max_rss=max_rss(),
+                operations=results)
+
+
+def git_revision():
+    "the commit checked out, so results can be told apart"
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__))
+            ).strip().decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summary(name, result):
+    if result['count'] == 1:
+        return '%s %.3fs' % (name, result['seconds'])
+    return '%s %.0f/s' % (name, result['ops_per_sec'] or 0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='comma separated trie sizes, e.g. 1000,1000000')
+    parser.add_argument('--ops', type=int, default=10000,
+                        help='keys read, proven, updated and deleted per size')
+    parser.add_argument('--operations', default=','.join(OPERATIONS),
+                        help='comma separated subset of ' +
+                        ','.join(OPERATIONS))
+    parser.add_argument('--secure', action='store_true',
+                        help='benchmark SecureTrie rather than Trie')
+    parser.add_argument('--deferred', action='store_true',
+                        help='use deferred tries')
+    parser.add_argument('--memory', action='store_true',
+                        help='trace the peak memory of every operation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='file to write, else stdout')
+    args = parser.parse_args(argv)
+
+    operations = args.operations.split(',')
+    for name in operations:
+        if name not in OPERATIONS:
+            parser.error('unknown operation %r' % name)
+    runs = []
+    for size in [int(s) for s in args.sizes.split(',')]:
+        r = benchmark(size, args.ops, args.secure, args.deferred, args.seed,
+                      args.memory, operations)
+        sys.stderr.write('%s %d: %s\n' % (r['trie'], size, ', '.join(
+            summary(name, r['operations'][name])
+            for name in OPERATIONS if name in r['operations'])))
+        runs.append(r)
+    o = dict(revision=git_revision(), python=platform.python_version(),
+             implementation=platform.python_implementation(),
+             seed=args.seed, ops=args.ops, runs=runs)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        json.dump(o, out, indent=2, sort_keys=True)
+        out.write('\n')
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
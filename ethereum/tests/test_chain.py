@@ -130,6 +130,51 @@ def test_failing_transfer(db):
     assert blk.get_balance(v2) == b_v2
 
 
+def test_account_cache(db):
+    k, v, k2, v2 = accounts()
+    blk = blocks.genesis(db, {v: {"balance": utils.denoms.ether * 1}})
+    acct = blk._get_acct(v)
+    assert blk._get_acct(v) is acct
+    assert blk.transfer_value(v, v2, 42)
+    assert blk.increment_nonce(v)
+    assert blk.dirty_fields[v] == set(['balance', 'nonce'])
+    assert blk.dirty_fields[v2] == set(['balance'])
+    blk.commit_state()
+    assert not blk.account_cache and not blk.dirty_fields
+    assert blk._get_acct(v) is not acct
+    assert blk._get_acct(v).balance == utils.denoms.ether * 1 - 42
+    assert blk._get_acct(v).nonce == 1
+    assert blk._get_acct(v2).balance == 42
+
+
+def test_snapshot_revert(db):
+    k, v, k2, v2 = accounts()
+    blk = blocks.genesis(db, {v: {"balance": 100}})
+    blk.set_balance(v2, 1)
+    outer = blk.snapshot()
+    blk.set_balance(v, 90)
+    blk.set_storage_data(v, 1, 5)
+    inner = blk.snapshot()
+    for i in range(10):
+        blk.set_balance(v, 80 - i)
+        blk.set_storage_data(v, 1, i)
+    # two entries for v2, three in the outer and two in the inner layer
+    assert len(blk.journal) == 7
+    blk.revert(inner)
+    assert blk.get_balance(v) == 90
+    assert blk.get_storage_data(v, 1) == 5
+    inner = blk.snapshot()
+    blk.set_balance(v, 70)
+    blk.revert(outer)
+    assert blk.get_balance(v) == 100
+    assert blk.get_storage_data(v, 1) == 0
+    assert blk.get_balance(v2) == 1
+    assert not blk.snapshots
+    blk.commit_state()
+    assert blk.get_balance(v) == 100
+    assert blk.get_balance(v2) == 1
+
+
 def test_serialize_block(db):
     blk = blocks.genesis(db)
     tb_blk = blocks.BlockHeader.from_block_rlp(rlp.encode(blk))
@@ -172,6 +217,22 @@ def test_deserialize_commit(db):
     assert blk == blocks.get_block(db, blk.hash)
 
 
+def test_split_block_storage(db):
+    k, v, k2, v2 = accounts()
+    blk = mkquickgenesis({v: {"balance": utils.denoms.ether * 1}}, db)
+    store_block(blk)
+    blk2 = mine_next_block(blk, coinbase=v)
+    assert blocks.has_block(db, blk2.hash)
+    assert b'header:' + blk2.hash in db and b'body:' + blk2.hash in db
+    header = blocks.get_block_header(db, blk2.hash)
+    assert header.hash == blk2.hash
+    assert header == blk2.header
+    assert blocks.get_block(db, blk2.hash) == blk2
+    assert blocks.chain_difficulty(db, header) == \
+        blk.difficulty + blk2.difficulty
+    assert blk2.get_ancestor(1).hash == blk.hash
+
+
 def test_genesis_db(db, alt_db):
     k, v, k2, v2 = accounts()
     blk = blocks.genesis(db, {v: {"balance": utils.denoms.ether * 1}})
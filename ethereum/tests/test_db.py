@@ -1,7 +1,8 @@
 import itertools
 import random
 import pytest
-from ethereum.db import _EphemDB
+from ethereum.db import _EphemDB, SQLiteDB, OverlayDB, NodeCacheDB, FamilyDB, \
+    InstrumentedDB, RecordingDB, get_family, key_prefix
 from rlp.utils import ascii_chr
 
 random.seed(0)
@@ -35,3 +36,275 @@ def test_ephem():
         assert key not in db
         with pytest.raises(KeyError):
             db.get(key)
+
+
+def test_sqlite(tmpdir):
+    path = str(tmpdir.join('test.db'))
+    db = SQLiteDB(path)
+    for key, value in content.items():
+        db.put(key, value)
+        assert key in db
+        assert db.get(key) == value
+    db.commit()
+    for key in content:
+        db.put(key, alt_content[key])
+    for key in list(content)[:4]:
+        db.delete(key)
+        assert key not in db
+        with pytest.raises(KeyError):
+            db.get(key)
+
+    # uncommitted changes are not persisted
+    reopened = SQLiteDB(path)
+    for key, value in content.items():
+        assert reopened.get(key) == value
+    reopened.close()
+
+    db.commit()
+    db.close()
+    reopened = SQLiteDB(path, sync='full')
+    for key in list(content)[:4]:
+        assert key not in reopened
+    for key in list(content)[4:]:
+        assert reopened.get(key) == alt_content[key]
+    reopened.close()
+
+
+def test_overlay():
+    parent = _EphemDB()
+    keys = list(content)
+    for key in keys[:4]:
+        parent.put(key, content[key])
+    db = OverlayDB(parent)
+    for key in keys:
+        db.put(key, alt_content[key])
+        assert db.get(key) == alt_content[key]
+    db.delete(keys[0])
+    assert keys[0] not in db
+    assert parent.get(keys[0]) == content[keys[0]]
+    assert keys[5] not in parent
+
+    db.rollback()
+    assert db.get(keys[0]) == content[keys[0]]
+    assert keys[5] not in db
+
+    db.put(keys[5], alt_content[keys[5]])
+    db.delete(keys[0])
+    db.delete(keys[6])
+    db.commit()
+    assert keys[0] not in parent
+    assert parent.get(keys[5]) == alt_content[keys[5]]
+    assert db.overlay == {}
+
+
+def test_node_cache():
+    from ethereum import trie
+    t = trie.Trie(_EphemDB())
+    for key, value in content.items():
+        t.update(key, value)
+
+    cache = NodeCacheDB(t.db)
+    cached = trie.Trie(cache, t.root_hash)
+    for key, value in content.items():
+        assert cached.get(key) == value
+    misses = cache.misses
+    assert misses > 0
+    for key, value in content.items():
+        assert cached.get(key) == value
+    assert cache.misses == misses
+    assert cache.hits > 0
+
+    # updates must not modify the cached nodes
+    for key in content:
+        cached.update(key, alt_content[key])
+    assert trie.Trie(cache, t.root_hash).to_dict() == t.to_dict()
+
+    node_key = next(iter(cache.nodes))
+    cache.delete(node_key)
+    assert node_key not in cache.nodes
+    assert node_key not in cache
+
+    small = NodeCacheDB(t.db, max_bytes=200)
+    trie.Trie(small, t.root_hash).to_dict()
+    assert small.evictions > 0
+    assert small.size <= 200
+    assert small.stats()['entries'] == len(small.nodes)
+
+
+def test_node_cache_rollback():
+    from ethereum import trie
+    overlay = OverlayDB(_EphemDB())
+    cache = NodeCacheDB(overlay)
+    t = trie.Trie(cache)
+    for key, value in content.items():
+        t.update(key, value)
+    assert trie.Trie(cache, t.root_hash).to_dict() == t.to_dict()
+    assert cache.nodes
+    cache.rollback()
+    assert not cache.nodes and cache.size == 0
+    assert t.root_hash not in cache
+    assert not trie.Trie(cache, t.root_hash).root_hash_valid()
+    try:
+        cache.get_node(t.root_hash)
+        assert False, 'discarded node served'
+    except KeyError:
+        pass
+
+
+def test_families(tmpdir):
+    from ethereum import trie, securetrie
+    default = SQLiteDB(str(tmpdir.join('default.db')))
+    nodes = _EphemDB()
+    db = FamilyDB(default, {'nodes': NodeCacheDB(nodes)})
+    t = securetrie.SecureTrie(trie.Trie(db))
+    for key, value in content.items():
+        t.update(key, value)
+    t.root_hash
+    db.put(b'HEAD', b'head')
+    assert t.trie.db is db.family('nodes')
+    assert len(nodes.db) > 0
+    assert t.to_dict() == content
+    assert db.family('nodes').db.misses > 0
+
+    # preimages share the default db, but are kept apart by their prefix
+    preimages = dict(db.family('preimages').iter_items())
+    assert sorted(preimages.values()) == sorted(content)
+    assert list(db.family('code').iter_items()) == []
+    assert db.family('nodes').family('preimages') is db.family('preimages')
+    assert b'HEAD' in default and b'HEAD' not in db.family('preimages')
+
+    db.commit()
+    assert default.uncommitted == {}
+    db.family('preimages').put(b'x', b'y')
+    db.rollback()
+    assert b'x' not in db.family('preimages')
+    assert dict(db.family('preimages').iter_items()) == preimages
+    db.compact()
+    assert default.get(b'HEAD') == b'head'
+
+
+@pytest.mark.parametrize('mkdb', ['ephem', 'sqlite', 'overlay'])
+def test_iter_items(tmpdir, mkdb):
+    if mkdb == 'ephem':
+        db = _EphemDB()
+    elif mkdb == 'sqlite':
+        db = SQLiteDB(str(tmpdir.join('test.db')))
+    else:
+        db = OverlayDB(_EphemDB())
+    for i in range(20):
+        db.put(('a:%d' % i).encode(), b'v')
+    db.put(b'b:0', b'v')
+    db.commit()
+    db.delete(b'a:3')
+    db.put(b'a:3x', b'w')
+    keys = [k for k, v in db.iter_items(b'a:')]
+    assert keys == sorted(keys)
+    assert len(keys) == 20
+    assert b'a:3' not in keys and b'a:3x' in keys
+    assert dict(db.iter_items(b'a:3')) == {b'a:3x': b'w'}
+
+
+def test_instrumented():
+    assert key_prefix(b'\x01' * 32) == b'hash'
+    assert key_prefix(b'blocknumber:12') == b'blocknumber:'
+    assert key_prefix(b'ci:' + b'\x01' * 32) == b'ci:'
+    assert key_prefix(b'HEAD') == b'HEAD'
+    assert key_prefix(b'\x01:') == b'other'
+
+    nodes = {random_string(32): value for value in alt_content.values()}
+    db = InstrumentedDB(_EphemDB())
+    for key, value in nodes.items():
+        db.put(key, value)
+    db.put(b'blocknumber:1', b'x')
+    for key in nodes:
+        db.get(key)
+        assert key in db
+    with pytest.raises(KeyError):
+        db.get(b'blocknumber:2')
+    db.delete(b'blocknumber:1')
+
+    stats = db.snapshot()
+    assert stats[b'hash']['put']['count'] == len(nodes)
+    assert stats[b'hash']['get']['bytes'] == 32 * len(nodes)
+    assert stats[b'hash']['has']['count'] == len(nodes)
+    assert stats[b'blocknumber:']['get']['count'] == 1
+    assert stats[b'blocknumber:']['delete']['count'] == 1
+    assert sum(stats[b'hash']['get']['histogram'].values()) == len(nodes)
+
+    db.log_commits = True
+    db.commit()
+    assert db.snapshot() == {}
+
+
+@pytest.mark.parametrize('mkdb', ['ephem', 'sqlite', 'overlay', 'family'])
+def test_many(tmpdir, mkdb):
+    if mkdb == 'ephem':
+        db = _EphemDB()
+    elif mkdb == 'sqlite':
+        db = SQLiteDB(str(tmpdir.join('test.db')))
+        db.max_variables = 3
+    elif mkdb == 'overlay':
+        db = OverlayDB(_EphemDB())
+    else:
+        db = FamilyDB(_EphemDB()).family('nodes')
+    keys = list(content)
+    db.put_many(content.items())
+    db.commit()
+    db.put_many((k, alt_content[k]) for k in keys[:3])
+    db.delete(keys[3])
+    values = db.get_many(keys + [b'missing', keys[0]])
+    assert values[:3] == [alt_content[k] for k in keys[:3]]
+    assert values[3] is None
+    assert values[4:-2] == [content[k] for k in keys[4:]]
+    assert values[-2:] == [None, alt_content[keys[0]]]
+    assert db.get_many([]) == []
+
+
+def test_node_cache_get_nodes():
+    from ethereum import trie
+    t = trie.Trie(_EphemDB())
+    for key, value in content.items():
+        t.update(key, value)
+    cache = NodeCacheDB(InstrumentedDB(t.db))
+    keys = list(t.db.db.keys())
+    nodes = cache.get_nodes(keys + keys[:1])
+    assert nodes == [trie.rlp.decode(t.db.get(k)) for k in keys + keys[:1]]
+    assert cache.misses == len(keys) and cache.hits == 1
+    stats = cache.db.snapshot()
+    assert sum(s['get']['count'] for s in stats.values()) == len(keys)
+    with pytest.raises(KeyError):
+        cache.get_nodes([b'\x00' * 32])
+
+
+def test_recording():
+    from ethereum import trie
+    db = FamilyDB(_EphemDB())
+    t = trie.Trie(db)
+    for key, value in content.items():
+        t.update(key, value)
+    get_family(db, 'code').put(b'c' * 32, b'code')
+
+    recorder = RecordingDB(db)
+    assert get_family(recorder, 'code').get(b'c' * 32) == b'code'
+    key = sorted(content)[0]
+    assert trie.Trie(recorder, t.root_hash).get(key) == content[key]
+    assert recorder.recorded
+    assert all(t.db.get(k) == v for k, v in recorder.recorded.items())
+    recorded = dict(recorder.recorded)
+
+    # nodes written through the recorder are stored in db, not recorded
+    written = trie.Trie(recorder, t.root_hash)
+    written.update(key, b'new')
+    trie.Trie(recorder, written.root_hash).get(key)
+    assert recorder.recorded == recorded
+    assert trie.Trie(db, written.root_hash).get(key) == b'new'
+
+    # checking a proof reads the nodes not written from the proof only
+    proof = _EphemDB()
+    proof.put_many(recorded.items())
+    checker = RecordingDB(db, proof)
+    assert trie.Trie(checker, t.root_hash).get(key) == content[key]
+    other = [k for k in content if len(content[k]) == 255 and
+             ord(k[0]) >> 4 != ord(key[0]) >> 4][0]
+    with pytest.raises(KeyError):
+        trie.Trie(checker, t.root_hash).get(other)
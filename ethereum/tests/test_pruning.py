@@ -0,0 +1,74 @@
+import ethereum.blocks as blocks
+import ethereum.utils as utils
+from ethereum import trie
+from ethereum.db import EphemDB
+from ethereum.pruning import StatePruner
+from ethereum.securetrie import SecureTrie
+
+coinbase = b'\x00' * 19 + b'\x01'
+accounts = [utils.sha3(str(i))[:20] for i in range(20)]
+
+
+def mkchain(db, length):
+    blk = blocks.genesis(db, {a: {"balance": 1} for a in accounts})
+    chain = [blk]
+    for i in range(length):
+        blk = blocks.Block.init_from_parent(blk, coinbase,
+                                            timestamp=blk.timestamp + 10)
+        for j, a in enumerate(accounts[:(i % 5) + 2]):
+            blk.set_balance(a, i + j)
+            blk.set_storage_data(a, i % 3, i)
+        blk.commit_state()
+        chain.append(blk)
+    return chain
+
+
+def state_nodes(db, root):
+    "all nodes of a state trie including the storage tries"
+    nodes = set()
+    stack = [(root, True)]
+    while stack:
+        key, is_state = stack.pop()
+        if key in nodes or key == trie.BLANK_ROOT:
+            continue
+        nodes.add(key)
+        refs, values = trie.node_children(blocks.rlp.decode(db.get(key)))
+        stack.extend((r, is_state) for r in refs)
+        if is_state:
+            stack.extend((blocks.rlp.decode(v)[2], False) for v in values)
+    return nodes
+
+
+def test_archive():
+    db = EphemDB()
+    chain = mkchain(db, 10)
+    pruner = StatePruner(db)
+    size = len(db.kv)
+    for blk in chain:
+        pruner.add_root(blk.number, blk.state_root)
+        pruner.prune(blk.number)
+    assert len(db.kv) == size
+
+
+def test_prune():
+    db = EphemDB()
+    chain = mkchain(db, 20)
+    depth = 3
+    pruner = StatePruner(db, depth)
+    for blk in chain:
+        pruner.add_root(blk.number, blk.state_root)
+        pruner.prune(blk.number)
+
+    kept = set()
+    for blk in chain[-depth:]:
+        kept |= state_nodes(db, blk.state_root)
+        state = SecureTrie(trie.Trie(db, blk.state_root))
+        for a in accounts:
+            state.get(a)
+    for blk in chain[:-depth]:
+        assert blk.state_root not in db
+    for key in kept:
+        assert pruner.get_refcount(key) > 0
+
+    # the tracked roots survive a restart
+    assert StatePruner(db, depth).roots == pruner.roots
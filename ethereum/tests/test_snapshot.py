@@ -0,0 +1,109 @@
+import io
+import pytest
+import rlp
+from rlp.utils import ascii_chr
+import ethereum.blocks as blocks
+import ethereum.utils as utils
+from ethereum import trie
+from ethereum.db import EphemDB, OverlayDB
+from ethereum.securetrie import SecureTrie
+from ethereum.snapshot import SnapshotDB, export_snapshot, export_state, \
+    import_state
+
+accounts = [utils.sha3(str(i))[:20] for i in range(20)]
+
+
+@pytest.fixture
+def state():
+    alloc = {a: {"balance": i} for i, a in enumerate(accounts)}
+    blk = blocks.genesis(EphemDB(), alloc)
+    for i, a in enumerate(accounts[:5]):
+        blk.set_code(a, b'\x60\x00' * (i + 1))
+        for k in range(10):
+            blk.set_storage_data(a, k, k * i + 1)
+    blk.commit_state()
+    return blk
+
+
+def load(state, db):
+    header = rlp.decode(rlp.encode(state.header), blocks.BlockHeader)
+    return blocks.Block(header, db=db)
+
+
+def test_snapshot(tmpdir, state):
+    path = str(tmpdir.join('state.snap'))
+    count = export_snapshot(state.db, state.state_root, path)
+    snap = SnapshotDB(path)
+    assert len(snap) == count
+    assert snap.root_hash == state.state_root
+
+    keys = [k for k, v in snap.iter_items()]
+    assert keys == sorted(keys)
+    for key, value in snap.iter_items():
+        assert snap.get(key) == value == state.db.get(key)
+    with pytest.raises(KeyError):
+        snap.get(b'\xff' * 32)
+    assert b'\x00' * 32 not in snap
+
+    t = SecureTrie(trie.Trie(snap, snap.root_hash))
+    acct = rlp.decode(t.get(accounts[3]), blocks.Account, db=snap)
+    assert acct.balance == 3
+    assert acct.code == state.get_code(accounts[3])
+    with pytest.raises(TypeError):
+        snap.put(b'\x00' * 32, b'')
+
+    blk = load(state, OverlayDB(snap))
+    for a in accounts:
+        assert blk.get_balance(a) == state.get_balance(a)
+        assert blk.get_code(a) == state.get_code(a)
+        for k in range(10):
+            assert blk.get_storage_data(a, k) == state.get_storage_data(a, k)
+    assert blk.get_balance(b'\x01' * 20) == 0
+    blk.set_balance(accounts[0], 12345)
+    blk.commit_state()
+    assert load(state, OverlayDB(snap)).get_balance(accounts[0]) == 0
+    snap.close()
+
+
+def test_blank_snapshot(tmpdir):
+    path = str(tmpdir.join('blank.snap'))
+    export_snapshot(EphemDB(), trie.BLANK_ROOT, path)
+    snap = SnapshotDB(path)
+    assert trie.Trie(snap, snap.root_hash).to_dict() == {}
+
+
+def test_not_a_snapshot(tmpdir):
+    path = tmpdir.join('garbage')
+    path.write(b'\x00' * 100)
+    with pytest.raises(ValueError):
+        SnapshotDB(str(path))
+
+
+def test_export_import(state):
+    f = io.BytesIO()
+    count = export_state(state.db, state.state_root, f)
+    assert count > len(accounts)
+    db = EphemDB()
+    f.seek(0)
+    assert import_state(f, db, batch_size=7) == state.state_root
+    blk = load(state, db)
+    for a in accounts:
+        assert blk.get_balance(a) == state.get_balance(a)
+        assert blk.get_code(a) == state.get_code(a)
+        for k in range(10):
+            assert blk.get_storage_data(a, k) == state.get_storage_data(a, k)
+
+    data = f.getvalue()
+    with pytest.raises(ValueError):
+        import_state(io.BytesIO(data[:-1]), EphemDB())
+    with pytest.raises(ValueError):
+        import_state(io.BytesIO(data[:len(data) // 2]), EphemDB())
+    corrupt = data[:100] + ascii_chr(ord(data[100:101]) ^ 1) + \
+        data[101:]
+    with pytest.raises(ValueError):
+        import_state(io.BytesIO(corrupt), EphemDB())
+
+    f = io.BytesIO()
+    export_state(EphemDB(), trie.BLANK_ROOT, f)
+    f.seek(0)
+    assert import_state(f, EphemDB()) == trie.BLANK_ROOT
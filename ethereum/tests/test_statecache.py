@@ -0,0 +1,70 @@
+import ethereum.blocks as blocks
+import ethereum.utils as utils
+from ethereum.db import EphemDB
+from ethereum.statecache import StateCache
+
+coinbase = b'\x00' * 19 + b'\x01'
+accounts = [utils.sha3(str(i))[:20] for i in range(5)]
+
+
+def mkgenesis():
+    cache = StateCache(max_items=100)
+    blk = blocks.genesis(EphemDB(), {a: {"balance": 1} for a in accounts},
+                         state_cache=cache)
+    return cache, blk
+
+
+def test_cache_lru():
+    cache = StateCache(max_items=2)
+    root = cache.advance(None, {b'a': b'1', b'b': b'2'})
+    assert cache.get_account(root, b'a') == b'1'
+    cache.put_account(root, b'c', b'3')
+    assert cache.get_account(root, b'b') is None
+    assert cache.get_account(root, b'a') == b'1'
+    assert cache.get_account(object(), b'a') is None
+    assert cache.rename(root, b'\x01' * 32) == b'\x01' * 32
+    assert cache.get_account(b'\x01' * 32, b'c') == b'3'
+    assert cache.stats()['evictions'] == 1
+
+
+def test_switch_lineage():
+    cache = StateCache()
+    root = cache.advance(None, {b'a': b'1'})
+    other = cache.advance(b'\x02' * 32, {b'b': b'2'})
+    assert cache.get_account(root, b'a') is None
+    assert cache.get_account(other, b'a') is None
+    assert cache.get_account(other, b'b') == b'2'
+
+
+def test_block_writes():
+    cache, blk = mkgenesis()
+    a = accounts[0]
+    blk.set_balance(a, 5)
+    blk.set_storage_data(a, 1, 7)
+    blk.commit_state()
+    assert cache.root is blk.cache_root
+    # served from the cache after the caches of the block were reset
+    hits = cache.hits
+    assert blk.get_balance(a) == 5
+    assert blk.get_storage_data(a, 1) == 7
+    assert cache.hits == hits + 2
+    blk.del_account(a)
+    assert blk.get_balance(a) == 0
+    assert not blk.account_exists(a)
+
+
+def test_child_block():
+    cache, blk = mkgenesis()
+    a = accounts[1]
+    blk.set_storage_data(a, 3, 9)
+    blk.commit_state()
+    child = blocks.Block.init_from_parent(blk, coinbase,
+                                          timestamp=blk.timestamp + 10)
+    assert child.cache_root == cache.root == blk.state_root
+    assert child.get_storage_data(a, 3) == 9
+    child.set_balance(a, 2)
+    child.commit_state()
+    assert child.get_balance(a) == 2
+    # the parent's state is not the cached one any more
+    assert blk.get_balance(a) == 1
+    assert blk.get_storage_data(a, 3) == 9
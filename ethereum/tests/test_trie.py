@@ -1,8 +1,10 @@
 import os
 import ethereum.testutils as testutils
 import json
+import rlp
 import ethereum.trie as trie
 import ethereum.db as db
+from ethereum import utils
 import itertools
 from ethereum.slogging import get_logger, configure_logging
 from rlp.utils import decode_hex, encode_hex
@@ -68,3 +70,306 @@ def test_emptyValues():
 
 def test_jeff():
     run_test('jeff')
+
+
+def test_prefetch():
+    keys = [os.urandom(32) for _ in range(200)]
+    t = trie.Trie(db.EphemDB())
+    for k in keys:
+        t.update(k, k)
+    t.update(b'\x01' * 32, b'\x01')  # embedded leaf next to other keys
+    t.update(b'\x01' * 31 + b'\x02', b'\x02')
+    cache = db.NodeCacheDB(t.db)
+    cached = trie.Trie(cache, t.root_hash)
+    wanted = keys[:20] + [b'\x01' * 32, os.urandom(32)]
+    cached.prefetch(wanted)
+    misses = cache.misses
+    assert misses > 20
+    for k in wanted:
+        assert cached.get(k) == t.get(k)
+    assert cache.misses == misses
+
+    # without a node cache there is nothing to warm
+    trie.Trie(t.db, t.root_hash).prefetch(keys)
+
+
+def test_deferred():
+    pairs = [(os.urandom(32), os.urandom(40)) for _ in range(200)]
+    pairs += [(b'\x01' * 32, b'\x01'), (b'\x01' * 31 + b'\x02', b'\x02')]
+    t = trie.Trie(db.EphemDB())
+    d = trie.Trie(db.EphemDB(), deferred=True)
+    for k, v in pairs:
+        t.update(k, v)
+        d.update(k, v)
+    assert len(d.db.db) == 0  # nothing hashed or stored yet
+    assert d.commit() == t.root_hash
+    for k, v in pairs[::3]:
+        t.delete(k)
+        d.delete(k)
+    for k, v in pairs[1::3]:
+        t.update(k, b'\x02' * 40)
+        d.update(k, b'\x02' * 40)
+    assert d.root_hash == t.root_hash
+    # every node reachable from the root was stored
+    reread = trie.Trie(d.db, d.root_hash)
+    for k, v in pairs[2::3]:
+        assert reread.get(k) == v
+
+
+def test_node_types():
+    t = trie.Trie(db.EphemDB())
+    for key in (b'do', b'dog', b'doge', b'horse'):
+        t.update(key, key * 10)
+    types = set()
+    for rlpnode in t.db.db.values():
+        node = rlp.decode(rlpnode)
+        node_type = t._get_node_type(node)
+        types.add(node_type)
+        if len(node) == 2:
+            terminated = trie.unpack_to_nibbles(node[0])[-1:] == [16]
+            assert terminated == (node_type == trie.NODE_TYPE_LEAF)
+    assert types == set([trie.NODE_TYPE_LEAF, trie.NODE_TYPE_EXTENSION,
+                         trie.NODE_TYPE_BRANCH])
+
+
+def test_next_prev():
+    keys = sorted(set([b'', b'\x01', b'\x01\x00', b'\x01\x02', b'\x10',
+                       b'\x11', b'\x11\x11\x11', b'\xff'] +
+                      [os.urandom(3) for _ in range(50)]))
+    t = trie.Trie(db.EphemDB())
+    for k in keys:
+        t.update(k, b'x' + k)
+    for i, k in enumerate(keys):
+        assert t.next(k) == (keys[i + 1] if i + 1 < len(keys) else None)
+        assert t.prev(k) == (keys[i - 1] if i else None)
+    assert t.next(b'\x01\x01') == b'\x01\x02'
+    assert t.prev(b'\x01\x01') == b'\x01\x00'
+
+
+def test_iter_items():
+    from ethereum.securetrie import SecureTrie
+    items = dict((os.urandom(i % 4), os.urandom(i % 40 + 1))
+                 for i in range(200))
+    t = trie.Trie(db.EphemDB())
+    for k, v in items.items():
+        t.update(k, v)
+    ordered = sorted(items.items())
+    assert list(t.iter_items()) == ordered
+    assert list(t.iter_items(reverse=True)) == ordered[::-1]
+    assert list(t) == sorted(items)
+    assert t.to_dict() == items
+    a, b = len(ordered) // 10, len(ordered) * 3 // 4
+    start, end = ordered[a][0], ordered[b][0]
+    assert list(t.iter_items(start, end)) == ordered[a:b]
+    assert list(t.iter_items(start, end, reverse=True)) == ordered[a:b][::-1]
+    assert list(t.iter_items(start=b'\x80')) == \
+        [(k, v) for k, v in ordered if k >= b'\x80']
+    assert list(t.iter_items(end=b'\x80')) == \
+        [(k, v) for k, v in ordered if k < b'\x80']
+
+    s = SecureTrie(trie.Trie(db.EphemDB()))
+    for k, v in items.items():
+        s.update(k, v)
+    assert s.to_dict() == items
+    assert len(list(s.iter_items(batch_size=7))) == len(items)
+    # entries without a preimage are not merged into one key
+    k = sorted(items)[0]
+    s.preimages.delete(utils.sha3(k))
+    try:
+        s.to_dict()
+        assert False, 'missing preimage not detected'
+    except KeyError as e:
+        assert e.args == (utils.sha3(k),)
+
+
+def test_cursor():
+    items = sorted(dict((os.urandom(i % 3 + 1), os.urandom(5))
+                        for i in range(300)).items())
+    keys = [k for k, v in items]
+    t = trie.Trie(db.EphemDB())
+    for k, v in items:
+        t.update(k, v)
+    c = t.cursor()
+    assert [c.next() for _ in items] == items
+    assert c.next() is None
+    c = t.cursor()
+    assert [c.prev() for _ in items] == items[::-1]
+    assert c.prev() is None
+
+    i = len(items) // 2
+    assert c.seek(keys[i]) == items[i]
+    assert c.next() == items[i + 1]
+    assert c.prev() == items[i]
+    assert c.prev() == items[i - 1]
+    assert c.seek(keys[i] + b'\x00') == items[i + 1]
+    assert c.seek(b'\xff' * 4) is None
+
+    pages = [c.range(start=b'', limit=7)]
+    while len(pages[-1]) == 7:
+        pages.append(c.range(limit=7))
+    assert sum(pages, []) == items
+    assert c.range(keys[10], keys[20]) == items[10:20]
+
+
+def test_from_sorted_items():
+    from ethereum.securetrie import SecureTrie
+    items = dict((os.urandom(i % 4 + i % 33), os.urandom(i % 40 + 1))
+                 for i in range(300))
+    t = trie.Trie(db.EphemDB())
+    for k, v in items.items():
+        t.update(k, v)
+    for deferred in (False, True):
+        b = trie.Trie.from_sorted_items(db.EphemDB(), sorted(items.items()),
+                                        deferred=deferred)
+        assert b.root_hash == t.root_hash
+        assert trie.Trie(b.db, b.root_hash).to_dict() == items
+    assert trie.Trie.from_sorted_items(db.EphemDB(), []).root_hash == \
+        trie.BLANK_ROOT
+    try:
+        trie.Trie.from_sorted_items(db.EphemDB(), [(b'b', b'1'), (b'a', b'2')])
+        assert False, 'unsorted keys accepted'
+    except Exception as e:
+        assert 'sorted' in str(e)
+
+    s = SecureTrie(trie.Trie(db.EphemDB()))
+    for k, v in items.items():
+        s.update(k, v)
+    b = SecureTrie.from_items(db.EphemDB(), items.items())
+    assert b.root_hash == s.root_hash
+    assert b.to_dict() == items
+
+
+def test_update_many():
+    from ethereum.securetrie import SecureTrie
+    items = list(dict((os.urandom(i % 20 + 1), os.urandom(i % 40 + 1))
+                      for i in range(200)).items())
+    changes = dict((os.urandom(8), os.urandom(i + 1)) for i in range(50))
+    changes.update((k, b'') for k, v in items[::3])
+    changes = list(changes.items())
+    for cls in (trie.Trie, SecureTrie):
+        for deferred in (False, True):
+            t = trie.Trie(db.EphemDB(), deferred=deferred)
+            m = trie.Trie(db.EphemDB(), deferred=deferred)
+            if cls is SecureTrie:
+                t, m = SecureTrie(t), SecureTrie(m)
+            for k, v in items:
+                t.update(k, v)
+            m.update_many(items)
+            assert m.root_hash == t.root_hash
+            for k, v in changes:
+                if v:
+                    t.update(k, v)
+                else:
+                    t.delete(k)
+            m.update_many(changes)
+            assert m.root_hash == t.root_hash
+            assert m.to_dict() == t.to_dict()
+
+    # a failing pair leaves a trie which is not deferred unchanged
+    m = trie.Trie(db.EphemDB())
+    m.update_many(items)
+    root = m.root_hash
+    try:
+        m.update_many([(b'\x00' * 21, b'x'), (b'\xff' * 33, b'')])
+        assert False, 'overlong key deleted'
+    except Exception as e:
+        assert 'length' in str(e)
+    assert m.root_hash == root and not m.deferred
+    assert m.get(b'\x00' * 21) == trie.BLANK_NODE
+
+
+def test_parallel_commit():
+    items = sorted((os.urandom(32), os.urandom(i % 40 + 1)) for i in range(500))
+    t = trie.Trie.from_sorted_items(db.EphemDB(), items)
+    p = trie.Trie.from_sorted_items(db.EphemDB(), items, processes=2)
+    assert p.root_hash == t.root_hash
+    assert p.db.db == t.db.db
+    assert not p.deferred
+
+    d = trie.Trie(db.EphemDB(), deferred=True)
+    for k, v in items:
+        d.update(k, v)
+    assert d.commit(processes=2) == t.root_hash
+    assert d.db.db == t.db.db
+
+
+def test_multiproof():
+    from ethereum.securetrie import SecureTrie
+    items = dict((os.urandom(i % 3 + 1), os.urandom(i % 40 + 1))
+                 for i in range(300))
+    t = trie.Trie(db.EphemDB(), deferred=True)
+    for k, v in items.items():
+        t.update(k, v)
+    keys = list(items)[:40] + [b'\xff' * 4, b'']
+    nodes = t.produce_multiproof(keys)
+    singles = set()
+    for k in keys:
+        reopened = trie.Trie(t.db, t.root_hash)
+        singles.update(rlp.encode(n) for n in reopened.produce_spv_proof(k))
+    assert len(nodes) == len(set(rlp.encode(n) for n in nodes))
+    assert set(rlp.encode(n) for n in nodes) == singles
+    values = trie.verify_multiproof(t.root_hash, keys, nodes)
+    assert values == [items.get(k, trie.BLANK_NODE) for k in keys]
+
+    try:
+        trie.verify_multiproof(t.root_hash, keys, nodes[1:])
+        assert False, 'incomplete proof accepted'
+    except trie.InvalidSPVProof:
+        pass
+    assert trie.verify_multiproof(trie.BLANK_ROOT, keys, []) == \
+        [trie.BLANK_NODE] * len(keys)
+
+    s = SecureTrie(trie.Trie(db.EphemDB()))
+    for k, v in items.items():
+        s.update(k, v)
+    nodes = s.produce_multiproof(keys)
+    hashed = [utils.sha3(k) for k in keys]
+    assert trie.verify_multiproof(s.root_hash, hashed, nodes) == \
+        [items.get(k, trie.BLANK_NODE) for k in keys]
+
+
+def test_threaded_proofs():
+    import threading
+    t = trie.Trie(db.EphemDB())
+    for i in range(200):
+        t.update(utils.sha3(utils.encode_int(i)), utils.encode_int(i) * 3)
+    keys = [utils.sha3(utils.encode_int(i)) for i in range(0, 200, 7)]
+
+    def produce(k):
+        return trie.Trie(t.db, t.root_hash).produce_spv_proof(k)
+    expected = dict((k, sorted(rlp.encode(n) for n in produce(k)))
+                    for k in keys)
+    errors = []
+
+    def prove():
+        try:
+            for k in keys:
+                nodes = produce(k)
+                assert sorted(rlp.encode(n) for n in nodes) == expected[k]
+                assert trie.verify_spv_proof(t.root_hash, k, nodes)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=prove) for _ in range(4)]
+    for th in threads:
+        th.start()
+    # only the tries opened on a recorder record
+    recorder = db.RecordingDB(t.db)
+    assert trie.Trie(recorder, t.root_hash).get(keys[0]) == \
+        utils.encode_int(0) * 3
+    recorded = dict(recorder.recorded)
+    assert sorted(recorded.values()) == expected[keys[0]]
+    assert t.get(keys[1]) == utils.encode_int(7) * 3
+    assert recorder.recorded == recorded
+    for th in threads:
+        th.join()
+    assert errors == [], errors
+
+
+def test_benchmark_trie():
+    from ethereum.tests import benchmark_trie
+    for secure, deferred in itertools.product([False, True], repeat=2):
+        r = benchmark_trie.benchmark(200, 50, secure, deferred)
+        assert sorted(r['operations']) == sorted(benchmark_trie.OPERATIONS)
+        assert r['operations']['insert']['count'] == 200
+        assert r['stored']['bytes'] > 200 * 64
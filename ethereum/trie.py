@@ -1,18 +1,43 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import binascii
+import multiprocessing
 import rlp
+from ethereum import db
+from ethereum.db import get_family
 from ethereum import utils
-from ethereum.utils import to_string
+from ethereum.utils import to_string, safe_ord
 from ethereum.abi import is_string
-import copy
-from rlp.utils import decode_hex, encode_hex, ascii_chr, str_to_bytes
+from rlp.utils import decode_hex, encode_hex, ascii_chr
 
-bin_to_nibbles_cache = {}
+if sys.version_info.major == 2:
+    from string import maketrans
+else:
+    maketrans = bytes.maketrans
 
-hti = {}
-for i, c in enumerate(b'0123456789abcdef'):
-    hti[c] = i
+# translate hex digits to nibble values and back, one byte per nibble
+hex_to_nibble = maketrans(b'0123456789abcdef', bytes(bytearray(range(16))))
+nibble_to_hex = maketrans(bytes(bytearray(range(16))), b'0123456789abcdef')
+
+
+def bin_to_path(s):
+    """convert string s to a nibble path, a bytearray with a nibble per byte
+
+    Trie internals use paths rather than lists of nibbles: they are built,
+    sliced, compared and packed without a Python level loop.
+
+    >>> list(bin_to_path(b"he"))
+    [6, 8, 6, 5]
+    """
+    return bytearray(binascii.hexlify(s).translate(hex_to_nibble))
+
+
+def path_to_bin(path):
+    """convert a nibble path of even length back to a string
+    """
+    return binascii.unhexlify(bytes(path.translate(nibble_to_hex)))
 
 
 def bin_to_nibbles(s):
@@ -27,7 +52,7 @@ def bin_to_nibbles(s):
     >>> bin_to_nibbles("hello")
     [6, 8, 6, 5, 6, 12, 6, 12, 6, 15]
     """
-    return [hti[c] for c in encode_hex(s)]
+    return list(bin_to_path(s))
 
 
 def nibbles_to_bin(nibbles):
@@ -37,63 +62,10 @@ def nibbles_to_bin(nibbles):
     if len(nibbles) % 2:
         raise Exception("nibbles must be of even numbers")
 
-    res = b''
-    for i in range(0, len(nibbles), 2):
-        res += ascii_chr(16 * nibbles[i] + nibbles[i + 1])
-    return res
+    return path_to_bin(bytearray(nibbles))
 
 
 NIBBLE_TERMINATOR = 16
-RECORDING = 1
-NONE = 0
-VERIFYING = -1
-
-proving = False
-
-
-class ProofConstructor():
-
-    def __init__(self):
-        self.mode = []
-        self.nodes = []
-        self.exempt = []
-
-    def push(self, mode, nodes=[]):
-        global proving
-        proving = True
-        self.mode.append(mode)
-        self.exempt.append(set())
-        if mode == VERIFYING:
-            self.nodes.append(set([rlp.encode(x) for x in nodes]))
-        else:
-            self.nodes.append(set())
-
-    def pop(self):
-        global proving
-        self.mode.pop()
-        self.nodes.pop()
-        self.exempt.pop()
-        if not self.mode:
-            proving = False
-
-    def get_nodelist(self):
-        return list(map(rlp.decode, list(self.nodes[-1])))
-
-    def get_nodes(self):
-        return self.nodes[-1]
-
-    def add_node(self, node):
-        node = rlp.encode(node)
-        if node not in self.exempt[-1]:
-            self.nodes[-1].add(node)
-
-    def add_exempt(self, node):
-        self.exempt[-1].add(rlp.encode(node))
-
-    def get_mode(self):
-        return self.mode[-1]
-
-proof = ProofConstructor()
 
 
 class InvalidSPVProof(Exception):
@@ -162,6 +134,36 @@ def unpack_to_nibbles(bindata):
     return o
 
 
+def is_terminated(bindata):
+    """test whether packed nibbles end with a terminator, reading the flags
+    without unpacking them
+
+    :param bindata: binary packed from nibbles
+    """
+    return bool(safe_ord(bindata[0]) & 0x20)
+
+
+def pack_path(path, terminated=False):
+    """pack a nibble path to binary, like `pack_nibbles`
+
+    :param path: nibble path, without terminator
+    :param terminated: whether the path leads to a value (leaf) or to a node
+    """
+    flags = 2 if terminated else 0
+    if len(path) % 2:
+        return path_to_bin(bytearray([flags | 1]) + path)
+    return path_to_bin(bytearray([flags, 0]) + path)
+
+
+def unpack_path(bindata):
+    """unpack binary packed from nibbles to a nibble path
+
+    :return: nibble path, without terminator
+    """
+    path = bin_to_path(bindata)
+    return path[1:] if path[0] & 1 else path[2:]
+
+
 def starts_with(full, part):
     ''' test whether the items in the part is
     the leading items of the full
@@ -171,6 +173,13 @@ def starts_with(full, part):
     return full[:len(part)] == part
 
 
+def common_prefix_length(a, b):
+    for i in range(min(len(a), len(b))):
+        if a[i] != b[i]:
+            return i
+    return min(len(a), len(b))
+
+
 (
     NODE_TYPE_BLANK,
     NODE_TYPE_LEAF,
@@ -187,19 +196,53 @@ BLANK_NODE = b''
 BLANK_ROOT = utils.sha3rlp(b'')
 
 
+def node_children(node):
+    """Return what `node` references, looking into embedded nodes.
+
+    :param node: node in form of list, or BLANK_NODE
+    :return: a tuple of the hashes of the referenced nodes and the values
+             stored in the node's leaves
+    """
+    refs, values = [], []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node == BLANK_NODE:
+            continue
+        elif len(node) == 17:
+            children = node[:16]
+            if node[16]:
+                values.append(node[16])
+        elif is_terminated(node[0]):
+            values.append(node[1])
+            continue
+        else:
+            children = [node[1]]
+        for child in children:
+            if isinstance(child, list):
+                stack.append(child)
+            elif child != BLANK_NODE:
+                refs.append(child)
+    return refs, values
+
+
 def transient_trie_exception(*args):
     raise Exception("Transient trie")
 
 
 class Trie(object):
 
-    def __init__(self, db, root_hash=BLANK_ROOT, transient=False):
+    def __init__(self, db, root_hash=BLANK_ROOT, transient=False,
+                 deferred=False):
         '''it also present a dictionary like interface
 
-        :param db key value database
+        :param db key value database, nodes are stored in its 'nodes' family
         :root: blank or trie node in form of [key, value] or [v0,v1..v15,v]
+        :param deferred: keep modified nodes in memory, unhashed, until the
+                         root hash is read or `commit` is called
         '''
-        self.db = db  # Pass in a database object directly
+        self.db = get_family(db, 'nodes')  # Pass in a database object directly
+        self.deferred = deferred
         self.transient = transient
         if self.transient:
             self.update = self.get = self.delete = transient_trie_exception
@@ -218,28 +261,6 @@ class Trie(object):
     # self.db = dbfile  # Pass in a database object directly
     #     self.set_root_hash(root_hash)
 
-    # For SPV proof production/verification purposes
-    def spv_grabbing(self, node):
-        global proving
-        if not proving:
-            pass
-        elif proof.get_mode() == RECORDING:
-            proof.add_node(copy.copy(node))
-            # print('recording %s' % encode_hex(utils.sha3(rlp.encode(node))))
-        elif proof.get_mode() == VERIFYING:
-            # print('verifying %s' % encode_hex(utils.sha3(rlp.encode(node))))
-            if rlp.encode(node) not in proof.get_nodes():
-                raise InvalidSPVProof("Proof invalid!")
-
-    def spv_storing(self, node):
-        global proving
-        if not proving:
-            pass
-        elif proof.get_mode() == RECORDING:
-            proof.add_exempt(copy.copy(node))
-        elif proof.get_mode() == VERIFYING:
-            proof.add_node(copy.copy(node))
-
     @property
     def root_hash(self):
         '''always empty or a 32 bytes string
@@ -249,15 +270,77 @@ class Trie(object):
     def get_root_hash(self):
         if self.transient:
             return self.transient_root_hash
+        if self._root_hash is not None:
+            return self._root_hash
         if self.root_node == BLANK_NODE:
             return BLANK_ROOT
         assert isinstance(self.root_node, list)
+        if self.deferred:
+            batch = []
+            self._commit_node(self.root_node, batch)
         val = rlp.encode(self.root_node)
         key = utils.sha3(val)
-        self.db.put(key, val)
-        self.spv_grabbing(self.root_node)
+        if self.deferred:
+            batch.append((key, val))
+            self.db.put_many(batch)
+        else:
+            self.db.put(key, val)
+        self._root_hash = key
         return key
 
+    def commit(self, processes=None):
+        ''' hash and store the nodes modified since the last commit
+
+        Only needed in deferred mode, other tries store every node as soon as
+        it is created.
+
+        :param processes: hash the subtrees below the topmost branch node in
+                          a pool of this many processes, with the same result
+        :return: the root hash
+        '''
+        if processes and self.deferred and self._root_hash is None:
+            self._commit_children_parallel(processes)
+        return self.get_root_hash()
+
+    def _commit_children_parallel(self, processes):
+        node = self.root_node
+        if node != BLANK_NODE and \
+                self._get_node_type(node) == NODE_TYPE_EXTENSION:
+            node = node[1]
+        if not isinstance(node, list) or len(node) != 17:
+            return
+        slots = [i for i in range(16) if isinstance(node[i], list)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_commit_subtree, [node[i] for i in slots])
+        finally:
+            pool.close()
+            pool.join()
+        for i, (encoded, batch) in zip(slots, results):
+            node[i] = encoded
+            self.db.put_many(batch)
+
+    def _commit_node(self, node, batch):
+        ''' replace the in-memory children of a node by their encoding
+
+        :param node: node in form of list
+        :param batch: list collecting (hash, rlp) of the nodes to store
+        '''
+        if len(node) == 17:
+            slots = range(16)
+        elif self._get_node_type(node) == NODE_TYPE_EXTENSION:
+            slots = [1]
+        else:
+            return
+        for i in slots:
+            child = node[i]
+            if isinstance(child, list):
+                self._commit_node(child, batch)
+                rlpnode = rlp.encode(child)
+                if len(rlpnode) >= 32:
+                    node[i] = utils.sha3(rlpnode)
+                    batch.append((node[i], rlpnode))
+
     @root_hash.setter
     def root_hash(self, value):
         self.set_root_hash(value)
@@ -268,10 +351,25 @@ class Trie(object):
         if self.transient:
             self.transient_root_hash = root_hash
             return
-        if root_hash == BLANK_ROOT:
+        if root_hash == BLANK_ROOT or root_hash == BLANK_NODE:
             self.root_node = BLANK_NODE
             return
-        self.root_node = self._decode_to_node(root_hash)
+        # the root node is decoded on first access, so a trie whose nodes
+        # have been pruned can still report its root hash
+        self._root_hash = root_hash
+        self._root_node = None
+
+    @property
+    def root_node(self):
+        if self._root_node is None:
+            self._root_node = self._decode_to_node(self._root_hash)
+        return self._root_node
+
+    @root_node.setter
+    def root_node(self, value):
+        # every modification of the trie passes here
+        self._root_node = value
+        self._root_hash = None
 
     def clear(self):
         ''' clear all tree data
@@ -294,13 +392,14 @@ class Trie(object):
         if node == BLANK_NODE:
             return BLANK_NODE
         assert isinstance(node, list)
+        if self.deferred:
+            return node  # hashed and stored by commit
         rlpnode = rlp.encode(node)
         if len(rlpnode) < 32:
             return node
 
         hashkey = utils.sha3(rlpnode)
         self.db.put(hashkey, rlpnode)
-        self.spv_storing(node)
         return hashkey
 
     def _decode_to_node(self, encoded):
@@ -308,9 +407,10 @@ class Trie(object):
             return BLANK_NODE
         if isinstance(encoded, list):
             return encoded
-        o = rlp.decode(self.db.get(encoded))
-        self.spv_grabbing(o)
-        return o
+        get_node = getattr(self.db, 'get_node', None)
+        if get_node is not None:
+            return get_node(encoded)
+        return rlp.decode(self.db.get(encoded))
 
     def _get_node_type(self, node):
         ''' get node type and content
@@ -321,19 +421,17 @@ class Trie(object):
         if node == BLANK_NODE:
             return NODE_TYPE_BLANK
 
-        if len(node) == 2:
-            nibbles = unpack_to_nibbles(node[0])
-            has_terminator = (nibbles and nibbles[-1] == NIBBLE_TERMINATOR)
-            return NODE_TYPE_LEAF if has_terminator\
-                else NODE_TYPE_EXTENSION
         if len(node) == 17:
             return NODE_TYPE_BRANCH
+        if len(node) == 2:
+            return NODE_TYPE_LEAF if is_terminated(node[0])\
+                else NODE_TYPE_EXTENSION
 
     def _get(self, node, key):
         """ get value inside a node
 
         :param node: node in form of list, or BLANK_NODE
-        :param key: nibble list without terminator
+        :param key: nibble path
         :return:
             BLANK_NODE if does not exist, otherwise value or hash
         """
@@ -350,13 +448,13 @@ class Trie(object):
             return self._get(sub_node, key[1:])
 
         # key value node
-        curr_key = without_terminator(unpack_to_nibbles(node[0]))
+        curr_key = unpack_path(node[0])
         if node_type == NODE_TYPE_LEAF:
             return node[1] if key == curr_key else BLANK_NODE
 
         if node_type == NODE_TYPE_EXTENSION:
             # traverse child nodes
-            if starts_with(key, curr_key):
+            if key.startswith(curr_key):
                 sub_node = self._decode_to_node(node[1])
                 return self._get(sub_node, key[len(curr_key):])
             else:
@@ -366,8 +464,8 @@ class Trie(object):
         """ update item inside a node
 
         :param node: node in form of list, or BLANK_NODE
-        :param key: nibble list without terminator
-            .. note:: key may be []
+        :param key: nibble path
+            .. note:: key may be empty
         :param value: value string
         :return: new node
 
@@ -378,7 +476,7 @@ class Trie(object):
         node_type = self._get_node_type(node)
 
         if node_type == NODE_TYPE_BLANK:
-            return [pack_nibbles(with_terminator(key)), value]
+            return [pack_path(key, True), value]
 
         elif node_type == NODE_TYPE_BRANCH:
             if not key:
@@ -394,6 +492,8 @@ class Trie(object):
             return self._update_kv_node(node, key, value)
 
     def _update_and_delete_storage(self, node, key, value):
+        if self.deferred:  # nothing stored yet, nothing to delete
+            return self._update(node, key, value)
         old_node = node[:]
         new_node = self._update(node, key, value)
         if old_node != new_node:
@@ -402,26 +502,21 @@ class Trie(object):
 
     def _update_kv_node(self, node, key, value):
         node_type = self._get_node_type(node)
-        curr_key = without_terminator(unpack_to_nibbles(node[0]))
+        curr_key = unpack_path(node[0])
         is_inner = node_type == NODE_TYPE_EXTENSION
 
-        # find longest common prefix
-        prefix_length = 0
-        for i in range(min(len(curr_key), len(key))):
-            if key[i] != curr_key[i]:
-                break
-            prefix_length = i + 1
+        prefix_length = common_prefix_length(key, curr_key)
 
         remain_key = key[prefix_length:]
         remain_curr_key = curr_key[prefix_length:]
 
-        if remain_key == [] == remain_curr_key:
+        if not remain_key and not remain_curr_key:
             if not is_inner:
                 return [node[0], value]
             new_node = self._update_and_delete_storage(
                 self._decode_to_node(node[1]), remain_key, value)
 
-        elif remain_curr_key == []:
+        elif not remain_curr_key:
             if is_inner:
                 new_node = self._update_and_delete_storage(
                     self._decode_to_node(node[1]), remain_key, value)
@@ -429,7 +524,7 @@ class Trie(object):
                 new_node = [BLANK_NODE] * 17
                 new_node[-1] = node[1]
                 new_node[remain_key[0]] = self._encode_node([
-                    pack_nibbles(with_terminator(remain_key[1:])),
+                    pack_path(remain_key[1:], True),
                     value
                 ])
         else:
@@ -438,105 +533,125 @@ class Trie(object):
                 new_node[remain_curr_key[0]] = node[1]
             else:
                 new_node[remain_curr_key[0]] = self._encode_node([
-                    pack_nibbles(
-                        adapt_terminator(remain_curr_key[1:], not is_inner)
-                    ),
+                    pack_path(remain_curr_key[1:], not is_inner),
                     node[1]
                 ])
 
-            if remain_key == []:
+            if not remain_key:
                 new_node[-1] = value
             else:
                 new_node[remain_key[0]] = self._encode_node([
-                    pack_nibbles(with_terminator(remain_key[1:])), value
+                    pack_path(remain_key[1:], True), value
                 ])
 
         if prefix_length:
             # create node for key prefix
-            return [pack_nibbles(curr_key[:prefix_length]),
+            return [pack_path(curr_key[:prefix_length]),
                     self._encode_node(new_node)]
         else:
             return new_node
 
-    def _getany(self, node, reverse=False, path=[]):
+    def _getany(self, node, reverse=False):
+        """ the path to the first (or last) key stored in a node
+
+        :param node: node in form of list, or BLANK_NODE
+        :return: nibble path ending with NIBBLE_TERMINATOR, or None if the
+                 node is blank
+        """
         node_type = self._get_node_type(node)
         if node_type == NODE_TYPE_BLANK:
             return None
         if node_type == NODE_TYPE_BRANCH:
-            if node[16]:
-                return [16]
+            if node[16] and not reverse:
+                return bytearray([NIBBLE_TERMINATOR])
             scan_range = list(range(16))
             if reverse:
                 scan_range.reverse()
             for i in scan_range:
-                o = self._getany(self._decode_to_node(node[i]), path=path + [i])
+                o = self._getany(self._decode_to_node(node[i]), reverse)
                 if o:
-                    return [i] + o
+                    return bytearray([i]) + o
+            if node[16]:
+                return bytearray([NIBBLE_TERMINATOR])
             return None
-        curr_key = without_terminator(unpack_to_nibbles(node[0]))
+        curr_key = unpack_path(node[0])
         if node_type == NODE_TYPE_LEAF:
-            return curr_key
+            return curr_key + bytearray([NIBBLE_TERMINATOR])
 
         if node_type == NODE_TYPE_EXTENSION:
-            curr_key = without_terminator(unpack_to_nibbles(node[0]))
-            sub_node = self._decode_to_node(node[1])
-            return self._getany(sub_node, path=path + curr_key)
+            o = self._getany(self._decode_to_node(node[1]), reverse)
+            return curr_key + o if o else None
+
+    def _iter(self, node, key, reverse=False):
+        """ the path to the key following (or preceding) `key` in a node
 
-    def _iter(self, node, key, reverse=False, path=[]):
+        :param node: node in form of list, or BLANK_NODE
+        :param key: nibble path
+        :return: nibble path ending with NIBBLE_TERMINATOR, or None if there
+                 is no such key
+        """
         node_type = self._get_node_type(node)
 
         if node_type == NODE_TYPE_BLANK:
             return None
 
         elif node_type == NODE_TYPE_BRANCH:
-            if len(key):
+            if key:
                 sub_node = self._decode_to_node(node[key[0]])
-                o = self._iter(sub_node, key[1:], reverse, path + [key[0]])
+                o = self._iter(sub_node, key[1:], reverse)
                 if o:
-                    return [key[0]] + o
-            if reverse:
-                scan_range = list(range(key[0] if len(key) else 0))
+                    return bytearray([key[0]]) + o
+                if reverse:
+                    scan_range = list(range(key[0] - 1, -1, -1))
+                else:
+                    scan_range = list(range(key[0] + 1, 16))
+            elif reverse:
+                # the value stored here is `key` itself, the others follow it
+                return None
             else:
-                scan_range = list(range(key[0] + 1 if len(key) else 0, 16))
+                scan_range = list(range(16))
             for i in scan_range:
-                sub_node = self._decode_to_node(node[i])
-                o = self._getany(sub_node, reverse, path + [i])
+                o = self._getany(self._decode_to_node(node[i]), reverse)
                 if o:
-                    return [i] + o
+                    return bytearray([i]) + o
             if reverse and node[16]:
-                return [16]
+                return bytearray([NIBBLE_TERMINATOR])
             return None
 
-        descend_key = without_terminator(unpack_to_nibbles(node[0]))
+        descend_key = unpack_path(node[0])
         if node_type == NODE_TYPE_LEAF:
             if reverse:
-                return descend_key if descend_key < key else None
+                found = descend_key < key
             else:
-                return descend_key if descend_key > key else None
+                found = descend_key > key
+            return descend_key + bytearray([NIBBLE_TERMINATOR]) \
+                if found else None
 
         if node_type == NODE_TYPE_EXTENSION:
             # traverse child nodes
             sub_node = self._decode_to_node(node[1])
-            sub_key = key[len(descend_key):]
-            if starts_with(key, descend_key):
-                o = self._iter(sub_node, sub_key, reverse, path + descend_key)
+            if key.startswith(descend_key):
+                o = self._iter(sub_node, key[len(descend_key):], reverse)
             elif descend_key > key[:len(descend_key)] and not reverse:
-                o = self._getany(sub_node, sub_key, False, path + descend_key)
+                o = self._getany(sub_node, False)
             elif descend_key < key[:len(descend_key)] and reverse:
-                o = self._getany(sub_node, sub_key, True, path + descend_key)
+                o = self._getany(sub_node, True)
             else:
                 o = None
             return descend_key + o if o else None
 
+    def cursor(self):
+        """ a :class:`Cursor` to walk the trie in key order
+        """
+        return Cursor(self)
+
     def next(self, key):
-        key = bin_to_nibbles(key)
-        o = self._iter(self.root_node, key)
-        return nibbles_to_bin(o) if o else None
+        o = self._iter(self.root_node, bin_to_path(key))
+        return path_to_bin(o[:-1]) if o else None
 
     def prev(self, key):
-        key = bin_to_nibbles(key)
-        o = self._iter(self.root_node, key, reverse=True)
-        return nibbles_to_bin(o) if o else None
+        o = self._iter(self.root_node, bin_to_path(key), reverse=True)
+        return path_to_bin(o[:-1]) if o else None
 
     def _delete_node_storage(self, node):
         '''delete storage
@@ -559,8 +674,8 @@ class Trie(object):
         """ update item inside a node
 
         :param node: node in form of list, or BLANK_NODE
-        :param key: nibble list without terminator
-            .. note:: key may be []
+        :param key: nibble path
+            .. note:: key may be empty
         :return: new node
 
         if this node is changed to a new node, it's parent will take the
@@ -591,7 +706,7 @@ class Trie(object):
 
         # the value item is not blank
         if not_blank_index == 16:
-            return [pack_nibbles(with_terminator([])), node[16]]
+            return [pack_path(bytearray(), True), node[16]]
 
         # normal item is not blank
         sub_node = self._decode_to_node(node[not_blank_index])
@@ -600,15 +715,17 @@ class Trie(object):
         if is_key_value_type(sub_node_type):
             # collape subnode to this node, not this node will have same
             # terminator with the new sub node, and value does not change
-            new_key = [not_blank_index] + \
-                unpack_to_nibbles(sub_node[0])
-            return [pack_nibbles(new_key), sub_node[1]]
+            new_key = bytearray([not_blank_index]) + unpack_path(sub_node[0])
+            return [pack_path(new_key, sub_node_type == NODE_TYPE_LEAF),
+                    sub_node[1]]
         if sub_node_type == NODE_TYPE_BRANCH:
-            return [pack_nibbles([not_blank_index]),
+            return [pack_path(bytearray([not_blank_index])),
                     self._encode_node(sub_node)]
         assert False
 
     def _delete_and_delete_storage(self, node, key):
+        if self.deferred:
+            return self._delete(node, key)
         old_node = node[:]
         new_node = self._delete(node, key)
         if old_node != new_node:
@@ -638,9 +755,9 @@ class Trie(object):
     def _delete_kv_node(self, node, key):
         node_type = self._get_node_type(node)
         assert is_key_value_type(node_type)
-        curr_key = without_terminator(unpack_to_nibbles(node[0]))
+        curr_key = unpack_path(node[0])
 
-        if not starts_with(key, curr_key):
+        if not key.startswith(curr_key):
             # key not found
             return node
 
@@ -666,11 +783,12 @@ class Trie(object):
         if is_key_value_type(new_sub_node_type):
             # collape subnode to this node, not this node will have same
             # terminator with the new sub node, and value does not change
-            new_key = curr_key + unpack_to_nibbles(new_sub_node[0])
-            return [pack_nibbles(new_key), new_sub_node[1]]
+            new_key = curr_key + unpack_path(new_sub_node[0])
+            return [pack_path(new_key, new_sub_node_type == NODE_TYPE_LEAF),
+                    new_sub_node[1]]
 
         if new_sub_node_type == NODE_TYPE_BRANCH:
-            return [pack_nibbles(curr_key), self._encode_node(new_sub_node)]
+            return [pack_path(curr_key), self._encode_node(new_sub_node)]
 
         # should be no more cases
         assert False
@@ -687,8 +805,9 @@ class Trie(object):
 
         self.root_node = self._delete_and_delete_storage(
             self.root_node,
-            bin_to_nibbles(to_string(key)))
-        self.get_root_hash()
+            bin_to_path(to_string(key)))
+        if not self.deferred:
+            self.get_root_hash()
 
     def _get_size(self, node):
         '''Get counts of (key, value) stored in this and the descendant nodes
@@ -712,63 +831,177 @@ class Trie(object):
             sizes = sizes + [1 if node[-1] else 0]
             return sum(sizes)
 
-    def _to_dict(self, node):
-        '''convert (key, value) stored in this and the descendant nodes
-        to dict items.
-
-        :param node: node in form of list, or BLANK_NODE
-
-        .. note::
-
-            Here key is in full form, rather than key of the individual node
-        '''
-        if node == BLANK_NODE:
-            return {}
+    def iter_items(self, start=None, end=None, reverse=False):
+        """ iterate over the (key, value) pairs in key order
 
-        node_type = self._get_node_type(node)
+        The trie is walked lazily, so only the nodes on the way to the next
+        item are held in memory, and subtrees outside the range are not read.
 
-        if is_key_value_type(node_type):
-            nibbles = without_terminator(unpack_to_nibbles(node[0]))
-            key = b'+'.join([to_string(x) for x in nibbles])
-            if node_type == NODE_TYPE_EXTENSION:
-                sub_dict = self._to_dict(self._decode_to_node(node[1]))
+        :param start: the smallest key to include, or None
+        :param end: the key to stop before, or None
+        :param reverse: iterate from the largest key down
+        """
+        start = None if start is None else bin_to_path(to_string(start))
+        end = None if end is None else bin_to_path(to_string(end))
+        # (path, encoded node) to walk, or (path, value) if is_value is set
+        stack = [(bytearray(), self.root_node, False)]
+        while stack:
+            path, item, is_value = stack.pop()
+            if is_value:
+                if (start is None or path >= start) and \
+                        (end is None or path < end):
+                    yield path_to_bin(path), item
+                continue
+            # all keys below path start with it
+            if start is not None and path < start[:len(path)]:
+                continue
+            if end is not None and path >= end:
+                continue
+            node = self._decode_to_node(item)
+            node_type = self._get_node_type(node)
+            if node_type == NODE_TYPE_BLANK:
+                continue
+            if node_type == NODE_TYPE_BRANCH:
+                children = [(path + bytearray([i]), node[i], False)
+                            for i in range(16) if node[i] != BLANK_NODE]
+                value = [(path, node[16], True)] if node[16] else []
+                if reverse:
+                    stack.extend(value + children)
+                else:
+                    stack.extend(children[::-1] + value)
             else:
-                sub_dict = {to_string(NIBBLE_TERMINATOR): node[1]}
+                stack.append((path + unpack_path(node[0]), node[1],
+                              node_type == NODE_TYPE_LEAF))
 
-            # prepend key of this node to the keys of children
-            res = {}
-            for sub_key, sub_value in sub_dict.items():
-                full_key = (key + b'+' + sub_key).strip(b'+')
-                res[full_key] = sub_value
-            return res
-
-        elif node_type == NODE_TYPE_BRANCH:
-            res = {}
-            for i in range(16):
-                sub_dict = self._to_dict(self._decode_to_node(node[i]))
+    def to_dict(self):
+        return dict(self.iter_items())
 
-                for sub_key, sub_value in sub_dict.items():
-                    full_key = (str_to_bytes(str(i)) + b'+' + sub_key).strip(b'+')
-                    res[full_key] = sub_value
+    def get(self, key):
+        return self._get(self.root_node, bin_to_path(to_string(key)))
 
-            if node[16]:
-                res[to_string(NIBBLE_TERMINATOR)] = node[-1]
-            return res
+    def _child_on_path(self, node, key):
+        """ the child of a node on the path to a key
 
-    def to_dict(self):
-        d = self._to_dict(self.root_node)
-        res = {}
-        for key_str, value in d.items():
-            if key_str:
-                nibbles = [int(x) for x in key_str.split(b'+')]
+        :param node: node in form of list, or BLANK_NODE
+        :param key: nibble path
+        :return: (child, the rest of the key), or None if the path ends
+        """
+        node_type = self._get_node_type(node)
+        if node_type == NODE_TYPE_BRANCH and key:
+            return node[key[0]], key[1:]
+        if node_type == NODE_TYPE_EXTENSION:
+            curr_key = unpack_path(node[0])
+            if key.startswith(curr_key):
+                return node[1], key[len(curr_key):]
+        return None
+
+    def prefetch(self, keys):
+        """ load the nodes on the paths to keys into the node cache
+
+        The paths are walked one level at a time, so the nodes of a level are
+        fetched with one multi-get rather than one lookup after another. Does
+        nothing unless the database caches decoded nodes (provides
+        `get_nodes`).
+        """
+        get_nodes = getattr(self.db, 'get_nodes', None)
+        if get_nodes is None:
+            return
+        paths = [(self.root_node, bin_to_path(to_string(key)))
+                 for key in keys]
+        while paths:
+            level = {}  # node hash -> rests of the keys passing it
+            for node, key in paths:
+                step = self._child_on_path(node, key)
+                while step is not None and isinstance(step[0], list):
+                    step = self._child_on_path(*step)  # embedded node
+                if step is not None and step[0] != BLANK_NODE:
+                    level.setdefault(step[0], []).append(step[1])
+            paths = []
+            hashkeys = list(level)
+            for hashkey, node in zip(hashkeys, get_nodes(hashkeys)):
+                paths.extend((node, rest) for rest in level[hashkey])
+
+    @classmethod
+    def from_sorted_items(cls, db, items, deferred=False, processes=None):
+        """ build a trie from (key, value) pairs sorted by key
+
+        The trie is built bottom up in one pass over `items`, so every node
+        is encoded and stored once rather than on every insertion below it.
+        The root hash is the same as when updating the keys one by one.
+
+        :param items: iterable of (key, value), the keys unique and in
+                      ascending order
+        :param deferred: build a deferred trie, see :class:`Trie`
+        :param processes: hash the nodes in a pool of this many processes,
+                          see :meth:`commit`
+        """
+        t = cls(db, deferred=deferred or bool(processes))
+        stream = t._sorted_paths(items)
+        first = next(stream, None)
+        if first is not None:
+            t.root_node = t._build_sorted(first, stream, 0)[0]
+        if processes:
+            t.commit(processes)
+            t.deferred = deferred
+        elif not deferred:
+            t.get_root_hash()
+        return t
+
+    @staticmethod
+    def _sorted_paths(items):
+        """ yield (path, value, length of the prefix shared with the next
+        path, -1 for the last one)
+        """
+        prev = None
+        for key, value in items:
+            path = bin_to_path(to_string(key))
+            if prev is not None:
+                if path <= prev[0]:
+                    raise Exception("Keys must be sorted and unique")
+                yield prev[0], prev[1], common_prefix_length(prev[0], path)
+            prev = path, value
+        if prev is not None:
+            yield prev[0], prev[1], -1
+
+    def _build_sorted(self, item, stream, depth):
+        """ build the node holding `item` and the items following it which
+        share its first `depth` nibbles
+
+        :return: (the node, not encoded, the first item not in it or None,
+                  the length of the prefix that item shares with the last
+                  item in the node)
+        """
+        path, value, shared = item
+        if shared < depth:
+            # the only item below here
+            leaf = [pack_path(path[depth:], True), value]
+            return leaf, next(stream, None), shared
+        node = [BLANK_NODE] * 17
+        while item is not None and shared >= depth:
+            path, value = item[:2]
+            if len(path) == depth:
+                node[16] = value
+                shared = item[2]
+                item = next(stream, None)
             else:
-                nibbles = []
-            key = nibbles_to_bin(without_terminator(nibbles))
-            res[key] = value
-        return res
-
-    def get(self, key):
-        return self._get(self.root_node, bin_to_nibbles(to_string(key)))
+                node[path[depth]], item, shared = \
+                    self._build_sorted(item, stream, depth + 1)
+
+        children = [i for i in range(16) if node[i] != BLANK_NODE]
+        if len(children) == 1 and not node[16]:
+            # no branching, prepend the nibble to the only child
+            i = children[0]
+            child = node[i]
+            child_type = self._get_node_type(child)
+            if is_key_value_type(child_type):
+                node = [pack_path(bytearray([i]) + unpack_path(child[0]),
+                                  child_type == NODE_TYPE_LEAF), child[1]]
+            else:
+                node = [pack_path(bytearray([i])), self._encode_node(child)]
+        else:
+            for i in children:
+                node[i] = self._encode_node(node[i])
+        return node, item, shared
 
     def __len__(self):
         return self._get_size(self.root_node)
@@ -783,7 +1016,7 @@ class Trie(object):
         return self.delete(key)
 
     def __iter__(self):
-        return iter(self.to_dict())
+        return (key for key, value in self.iter_items())
 
     def __contains__(self, key):
         return self.get(key) != BLANK_NODE
@@ -806,9 +1039,32 @@ class Trie(object):
         #     return self.delete(key)
         self.root_node = self._update_and_delete_storage(
             self.root_node,
-            bin_to_nibbles(to_string(key)),
+            bin_to_path(to_string(key)),
             value)
-        self.get_root_hash()
+        if not self.deferred:
+            self.get_root_hash()
+
+    def update_many(self, items):
+        '''
+        :param items: (key, value) pairs, applied in key order; a key whose
+                      value is empty is deleted
+
+        The modified nodes are kept in memory until all pairs are applied, so
+        a node on the paths of several keys is hashed and stored once. A trie
+        which is not deferred applies them to a deferred copy and takes over
+        its root hash, so it is left unchanged if a pair fails.
+        '''
+        if self.transient:
+            transient_trie_exception()
+        t = self if self.deferred else Trie(self.db, self.root_hash,
+                                            deferred=True)
+        for key, value in sorted(items):
+            if value == BLANK_NODE:
+                t.delete(key)
+            else:
+                t.update(key, value)
+        if t is not self:
+            self.set_root_hash(t.commit())
 
     def root_hash_valid(self):
         if self.root_hash == BLANK_ROOT:
@@ -816,35 +1072,299 @@ class Trie(object):
         return self.root_hash in self.db
 
     def produce_spv_proof(self, key):
-        proof.push(RECORDING)
-        self.get(key)
-        o = proof.get_nodelist()
-        proof.pop()
+        ''' prove the value of `key`, to be checked with
+        :func:`verify_spv_proof`
+
+        The key is looked up in a copy of the trie opened on a
+        :class:`ethereum.db.RecordingDB`, so this trie and the other tries
+        on its database are not affected.
+
+        :return: list of the nodes read
+        '''
+        recorder = db.RecordingDB(self.db)
+        Trie(recorder, self.root_hash).get(key)
+        return recorder.get_nodelist()
+
+    def _get_many(self, keys, nodes=None):
+        """ look up several keys, reading each node on their paths once
+
+        The paths are walked one level at a time, like in `prefetch`.
+
+        :param nodes: dict to collect the nodes read in, by hash
+        :return: list of the values, BLANK_NODE for the keys not present
+        """
+        values = [BLANK_NODE] * len(keys)
+        paths = [(self.root_node, bin_to_path(to_string(key)), i)
+                 for i, key in enumerate(keys)]
+        while paths:
+            level = {}  # node hash -> (rest of the key, index) passing it
+            for node, key, i in paths:
+                while True:
+                    node_type = self._get_node_type(node)
+                    if node_type == NODE_TYPE_LEAF:
+                        if unpack_path(node[0]) == key:
+                            values[i] = node[1]
+                        break
+                    if node_type == NODE_TYPE_BRANCH and not key:
+                        values[i] = node[16]
+                        break
+                    step = self._child_on_path(node, key)
+                    if step is None or step[0] == BLANK_NODE:
+                        break
+                    if not isinstance(step[0], list):
+                        level.setdefault(step[0], []).append((step[1], i))
+                        break
+                    node, key = step  # embedded node
+            paths = []
+            for hashkey, rests in level.items():
+                node = self._decode_to_node(hashkey)
+                if nodes is not None:
+                    nodes[hashkey] = node
+                paths.extend((node, key, i) for key, i in rests)
+        return values
+
+    def produce_multiproof(self, keys):
+        """ prove the values of several keys at once
+
+        :return: list of the nodes on the paths to `keys`, each node once,
+                 see :func:`verify_multiproof`
+        """
+        root_hash = self.root_hash  # stores the nodes of a deferred trie
+        if root_hash == BLANK_ROOT:
+            return []
+        nodes = {root_hash: self.root_node}
+        self._get_many(keys, nodes)
+        return list(nodes.values())
+
+
+def _commit_subtree(node):
+    """ hash an in-memory subtree of a deferred trie in a worker process
+
+    :return: (the node or its hash, as its parent references it,
+              list of (hash, rlp) of the nodes to store)
+    """
+    batch = []
+    Trie(db.EphemDB(), deferred=True)._commit_node(node, batch)
+    rlpnode = rlp.encode(node)
+    if len(rlpnode) < 32:
+        return node, batch
+    hashkey = utils.sha3(rlpnode)
+    batch.append((hashkey, rlpnode))
+    return hashkey, batch
+
+
+class Cursor(object):
+
+    """A position in a trie, moved from key to key in key order.
+
+    The cursor keeps the nodes on the path to its current item, so moving to
+    the next or previous item takes amortized constant time rather than a
+    walk down from the root like :meth:`Trie.next`. A new cursor is before
+    the first and after the last item; a cursor moved past either end stays
+    there. Modifying the trie invalidates its cursors.
+
+    :param trie: the :class:`Trie` to walk
+    """
+
+    def __init__(self, trie):
+        self.trie = trie
+        # [path, node, rank] from the root down to the current item, rank
+        # being the branch slot taken, -1 for the value, None for kv nodes
+        self.stack = None
+
+    def _item(self):
+        path, node, rank = self.stack[-1]
+        if rank is None:
+            return path_to_bin(path + unpack_path(node[0])), node[1]
+        return path_to_bin(path), node[16]
+
+    @staticmethod
+    def _next_rank(node, rank, reverse):
+        """ the rank of the slot of a branch node following (or preceding)
+        `rank` that is not blank, the value ranking before the children
+        """
+        if reverse:
+            for i in range(min(rank, 16) - 1, -1, -1):
+                if node[i] != BLANK_NODE:
+                    return i
+            if rank > -1 and node[16]:
+                return -1
+        else:
+            if rank < -1 and node[16]:
+                return -1
+            for i in range(max(rank + 1, 0), 16):
+                if node[i] != BLANK_NODE:
+                    return i
+        return None
+
+    def _descend(self, path, encoded, reverse):
+        """ push the nodes down to the first (or last) item below a node
+        """
+        node = self.trie._decode_to_node(encoded)
+        while True:
+            node_type = self.trie._get_node_type(node)
+            if node_type == NODE_TYPE_BLANK:
+                return False
+            if node_type == NODE_TYPE_LEAF:
+                self.stack.append([path, node, None])
+                return True
+            if node_type == NODE_TYPE_EXTENSION:
+                self.stack.append([path, node, None])
+                path = path + unpack_path(node[0])
+                node = self.trie._decode_to_node(node[1])
+                continue
+            rank = self._next_rank(node, 16 if reverse else -2, reverse)
+            self.stack.append([path, node, rank])
+            if rank == -1:
+                return True
+            path = path + bytearray([rank])
+            node = self.trie._decode_to_node(node[rank])
+
+    def _step(self, reverse):
+        while self.stack:
+            frame = self.stack[-1]
+            path, node, rank = frame
+            if rank is not None:
+                rank = self._next_rank(node, rank, reverse)
+                if rank is not None:
+                    frame[2] = rank
+                    if rank == -1 or self._descend(
+                            path + bytearray([rank]), node[rank], reverse):
+                        return self._item()
+            self.stack.pop()
+        return None
+
+    def first(self):
+        """ move to the first item
+
+        :return: (key, value), or None if the trie is empty
+        """
+        self.stack = []
+        if self._descend(bytearray(), self.trie.root_node, False):
+            return self._item()
+
+    def last(self):
+        """ move to the last item
+
+        :return: (key, value), or None if the trie is empty
+        """
+        self.stack = []
+        if self._descend(bytearray(), self.trie.root_node, True):
+            return self._item()
+
+    def seek(self, key):
+        """ move to the first item whose key is not smaller than `key`
+
+        :return: (key, value), or None if there is no such item
+        """
+        self.stack = []
+        path, rest = bytearray(), bin_to_path(to_string(key))
+        node = self.trie.root_node
+        while True:
+            node_type = self.trie._get_node_type(node)
+            if node_type == NODE_TYPE_BLANK:
+                return None
+            if node_type == NODE_TYPE_BRANCH:
+                if not rest:
+                    self.stack.append([path, node, -1])
+                    return self._item() if node[16] else self._step(False)
+                self.stack.append([path, node, rest[0]])
+                if node[rest[0]] == BLANK_NODE:
+                    return self._step(False)
+                path = path + rest[:1]
+                node = self.trie._decode_to_node(node[rest[0]])
+                rest = rest[1:]
+                continue
+            curr_key = unpack_path(node[0])
+            if node_type == NODE_TYPE_EXTENSION and rest.startswith(curr_key):
+                self.stack.append([path, node, None])
+                path = path + curr_key
+                node = self.trie._decode_to_node(node[1])
+                rest = rest[len(curr_key):]
+                continue
+            # all keys below this node are either smaller or greater
+            if curr_key >= rest:
+                self._descend(path, node, False)
+                return self._item()
+            return self._step(False)
+
+    def next(self):
+        """ move to the next item
+
+        :return: (key, value), or None after the last item
+        """
+        if self.stack is None:
+            return self.first()
+        return self._step(False)
+
+    def prev(self):
+        """ move to the previous item
+
+        :return: (key, value), or None before the first item
+        """
+        if self.stack is None:
+            return self.last()
+        return self._step(True)
+
+    def range(self, start=None, end=None, limit=None):
+        """ read a page of items in key order
+
+        The page starts at the first key not smaller than `start` or, if
+        `start` is None, with the item after the current one, and ends
+        before `end` or after `limit` items. A page cut by `limit` leaves
+        the cursor on its last item, so the following page is read by
+        calling again without `start`.
+
+        :return: list of (key, value)
+        """
+        o = []
+        if limit == 0:
+            return o
+        item = self.next() if start is None else self.seek(start)
+        while item is not None and (end is None or item[0] < end):
+            o.append(item)
+            if len(o) == limit:
+                break
+            item = self.next()
         return o
 
 
-def verify_spv_proof(root, key, proof):
-    proof.push(VERIFYING, proof)
+def verify_multiproof(root, keys, nodes):
+    """ check a proof made by :meth:`Trie.produce_multiproof`
+
+    :return: list of the values of `keys`, BLANK_NODE for the keys proven
+             not to be present
+    :raises InvalidSPVProof: if a node needed is not in the proof
+    """
+    t = Trie(db.EphemDB())
+    for node in nodes:
+        rlpnode = rlp.encode(node)
+        t.db.put(utils.sha3(rlpnode), rlpnode)
+    try:
+        t.root_hash = root
+        return t._get_many(keys)
+    except KeyError:
+        raise InvalidSPVProof("Proof invalid!")
+
+
+def verify_spv_proof(root, key, nodes):
     t = Trie(db.EphemDB())
 
-    for i, node in enumerate(proof):
+    for i, node in enumerate(nodes):
         R = rlp.encode(node)
         H = utils.sha3(R)
         t.db.put(H, R)
     try:
         t.root_hash = root
         t.get(key)
-        proof.pop()
         return True
     except Exception as e:
         print(e)
-        proof.pop()
         return False
 
 
 if __name__ == "__main__":
     import sys
-    from . import db
 
     _db = db.DB(sys.argv[2])
 
@@ -318,7 +318,7 @@ def print_func_call(ignore_first_arg=False, max_call_number=100):
 
 def dump_state(trie):
     res = ''
-    for k, v in list(trie.to_dict().items()):
+    for k, v in trie.iter_items():
         res += '%r:%r\n' % (encode_hex(k), encode_hex(v))
     return res
 